@@ -6,23 +6,71 @@
     This script is a one-off for converting CESM-style 'docbook'
     documents to ReST.
 
+    It can also be imported, e.g.,
+      import db2rst
+      for line in db2rst.convert_stream(open('book.xml')):
+        ...
+    or db2rst.convert_file('book.xml', 'book.rst'). A Converter object
+    carries the aliases and section state from one document to the next.
+    A document which cannot be converted raises ConversionError.
+
 """
 
 # Python 3 compatible printing in Python 2.
 from __future__ import print_function
 import sys
 import re
+import itertools
 import argparse
 import subprocess
 import shutil
+import filecmp
 import os
 import os.path
+import posixpath
+import multiprocessing
+import multiprocessing.pool
+import tempfile
+import traceback
+import hashlib
+import json
+import shlex
+import xml.parsers.expat
+import time
+import threading
+import contextlib
+try:
+  from shutil import which
+except ImportError:
+  from distutils.spawn import find_executable as which
+# End try
+# Best timer for intervals
+_clock = getattr(time, 'perf_counter', time.time)
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
+# End try
+try:
+  from cStringIO import StringIO as _SourceIO
+except ImportError:
+  from io import BytesIO as _SourceIO
+# End try
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+# End try
 
 # Globals (since this is meant to be a one-off sript)
 fulltagRE  = re.compile(r"<([^>]+)>([^<]*)</\1>")
 opentagRE  = re.compile(r"(<[^>]+>)")
 codeItemRE = re.compile(r"&([^;]+);")
 doctypeRE =  re.compile(r"^[ ]*<!DOCTYPE ")
+# A prefix of a line where every quoted string is closed
+quotedRE   = re.compile(r"""[^'"]*(?:(?:'[^']*'|"[^"]*")[^'"]*)*""")
+tagtokenRE = re.compile(r"""'[^']*'|"[^"]*"|[<>]""")
+angleRE    = re.compile(r"[<>]")
 ignore_tags = ( '?xml', 'para', '/chapter', '/sect1', '/sect2', '/sect3' )
 stringsubs = { '&lt;'         : '<',    '&gt;'          : '>',
                '<command>'    : '``',   '</command>'    : '``',
@@ -39,7 +87,33 @@ sectMarkers = { 'chapter' : '################################################',
                 'sect2'   : '^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^',
                 'sect3'   : '""""""""""""""""""""""""""""""""""""""""""""""""'}
 overbarSect = [ 'chapter', 'sect1' ]
-lastSect = None
+# Small integer codes (bits, so the tags on a line can be or'ed together)
+# for the tags which are checked, by name. Fixed when the module loads.
+_T_OTHER, _T_IGNORE, _T_ATOMIC, _T_END_ATOMIC = 0, 1, 2, 4
+_T_BOOK, _T_END_BOOK, _T_ENTITY = 8, 16, 32
+_T_VERBATIM, _T_END_VERBATIM = 64, 128
+_tag_codes = dict([ (_x, _T_IGNORE) for _x in ignore_tags ] +
+                  [ (_x, _T_ATOMIC) for _x in ('link', 'ulink', 'bookinfo') ] +
+                  [ ('/' + _x, _T_END_ATOMIC) for _x in ('link', 'ulink',
+                                                         'bookinfo') ] +
+                  [ ('book', _T_BOOK), ('/book', _T_END_BOOK),
+                    ('!ENTITY', _T_ENTITY) ] +
+                  [ (_x, _T_VERBATIM) for _x in ('screen', 'programlisting') ] +
+                  [ ('/' + _x, _T_END_VERBATIM) for _x in ('screen',
+                                                           'programlisting') ])
+_intern = getattr(sys, 'intern', None) or intern
+_stringsubs_engine = None
+_profile = None # The _Profile being recorded (see --profile)
+_io_buffer = 1 << 20 # Buffer size for reading sources and writing outputs
+_pipeline = None # The _IOPipeline of a serial conversion (see --prefetch)
+_translation_memo = None # The _TranslationMemo shared by Converters
+_alias_versions = {} # (version, trigger, value) -> alias table version
+_xref_files = {} # Source path -> its _XrefIndex scan (see _XrefIndex.scan)
+_converter_sha = None
+_doctype_tables = {} # DOCTYPE declarations read (or loaded) by source key
+_source_digests = None # Source path -> SHA-1 during a run (_source_hash)
+_alias_engines = [] # (history, engine) built most recently (_alias_engine)
+_instrumented = False
 preamble = """
 .. toctree::
    :maxdepth: 3
@@ -49,15 +123,73 @@ preamble = """
 
 
 def _main():
-  aliases = {}
-  # Create an argument parser and parse command line arguments
-  parser = argparse.ArgumentParser(usage='project [options]',
+  parser = _parser()
+  args = parser.parse_args()
+  try:
+    _run(parser, args)
+  except ConversionError as e:
+    sys.exit(str(e))
+  # End try
+# End def _main
+
+def _run(parser, args):
+  # Do what the parsed command line args ask
+  if (args.batch is not None):
+    if (args.project is not None):
+      parser.error('a project cannot be given with --batch')
+    # End if
+    # Book options belong on the manifest lines, they would be ignored here
+    defaults = parser.parse_args([])
+    for action in parser._actions:
+      if ((len(action.option_strings) > 0) and
+          (action.dest not in ('help', 'batch', 'batch_jobs')) and
+          (getattr(args, action.dest) != getattr(defaults, action.dest))):
+        parser.error('%s cannot be used with --batch'%
+                     max(action.option_strings, key=len))
+      # End if
+    # End for
+    _convert_batch(parser, args.batch, args.batch_jobs)
+  elif (args.project is None):
+    parser.error('a project (or --batch) is required')
+  elif (args.watch):
+    _watch_project(args)
+  else:
+    _convert_project(args)
+  # End if
+# End def _run
+
+def _parser():
+  # Create an argument parser for command line (or batch manifest) arguments
+  parser = argparse.ArgumentParser(usage='project [options] | --batch MANIFEST [--batch-jobs N]',
                                    description='Convert a docbook document to a Sphinx ReST document')
-  parser.add_argument('project', help='Project name, also name of document')
+  parser.add_argument('project', nargs='?',
+                      help='Project name, also name of document')
   parser.add_argument('-d', '--docbook-source',
                       help='Main docbook document name')
   parser.add_argument('--destination', default='doc',
                       help='New directory for ReST version of document')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help='number of processes used to convert sub-documents')
+  parser.add_argument('--shard-lines', type=int, default=0, metavar='N',
+                      help='with -j, split documents of more than N lines at sect1/sect2 tags and convert the parts in parallel (line parser only)')
+  parser.add_argument('--incremental', action='store_true',
+                      help='only convert sources changed since the last run')
+  parser.add_argument('--prefetch', type=int, default=0, metavar='N',
+                      help='read up to N sub-documents ahead and write outputs in the background (for slow file systems, without -j)')
+  parser.add_argument('--copy-jobs', type=int, default=4, metavar='N',
+                      help='number of threads copying images into the destination')
+  parser.add_argument('--build', action='store_true',
+                      help='run sphinx-build (html) after converting (implies --incremental, the previous build is kept)')
+  parser.add_argument('--build-jobs', default='auto', metavar='N',
+                      help='sphinx-build -j (processes building, default auto)')
+  parser.add_argument('--parser', choices=sorted(_readers), default='line',
+                      help='read DocBook line by line or with an XML parser (well-formed XML only)')
+  parser.add_argument('--memo-size', type=int, default=4096, metavar='N',
+                      help='remember the translations of up to N distinct lines (0 for none)')
+  parser.add_argument('--profile', action='store_true',
+                      help='report calls and time for each conversion phase')
+  parser.add_argument('--profile-json', metavar='FILE',
+                      help='also write the --profile report to FILE as JSON')
   struct = parser.add_argument_group('Structure options')
   struct.add_argument('--no-sep',
                       help='if specified, do not separate source and build dirs')
@@ -94,7 +226,175 @@ e')
                     help='not use make-mode for Makefile/make.bat')
   make.add_argument('-m', '--use-make-mode',
                     help='use make-mode for Makefile/make.bat')
-  args = parser.parse_args()
+  scaffold = parser.add_argument_group('Scaffold options')
+  scaffold.add_argument('--reuse-scaffold', action='store_true',
+                        help='keep an existing conf.py and Makefile in the destination, only rewrite converted sources')
+  scaffold.add_argument('--scaffold-cache', default=_default_cache('scaffolds'),
+                        help='directory of cached sphinx-quickstart output')
+  scaffold.add_argument('--no-scaffold-cache', action='store_true',
+                        help='always run sphinx-quickstart')
+  scaffold.add_argument('--doctype-cache', default=_default_cache('doctypes'),
+                        help='directory of cached DOCTYPE declarations')
+  scaffold.add_argument('--no-doctype-cache', action='store_true',
+                        help='always read DOCTYPE declarations')
+  scaffold.add_argument('--xref-cache', default=_default_cache('xrefs'),
+                        help='directory of cached id indexes')
+  scaffold.add_argument('--no-xref-cache', action='store_true',
+                        help='always scan all documents for ids')
+  watch = parser.add_argument_group('Watch options')
+  watch.add_argument('--watch', action='store_true',
+                     help='keep running, convert again (incrementally) whenever a source is saved')
+  watch.add_argument('--watch-interval', type=float, default=1.0,
+                     metavar='SECONDS', help='how often sources are checked')
+  batch = parser.add_argument_group('Batch options')
+  batch.add_argument('--batch', metavar='MANIFEST',
+                     help='convert every book in MANIFEST, a file with the arguments for one book (project [options]) per line')
+  batch.add_argument('--batch-jobs', type=int, default=1,
+                     help='number of processes converting books (each book then uses one job)')
+  return parser
+# End def _parser
+
+def _convert_project(args):
+  # Create the Sphinx project for one book from its parsed arguments,
+  # return its manifest
+  global _profile
+  start = time.time()
+  if (args.profile or (args.profile_json is not None)):
+    _instrument()
+    _profile = _Profile()
+    try:
+      manifest = _convert_book(args)
+    finally:
+      _profile.report()
+      if (args.profile_json is not None):
+        _profile.save(args.profile_json)
+      # End if
+      _profile = None
+    # End try
+  else:
+    manifest = _convert_book(args)
+  # End if
+  if (args.build):
+    convert_end = time.time()
+    if (len(manifest.written) > 0):
+      status = _sphinx_build(args.destination, args.build_jobs)
+      if (status != 0):
+        os.remove(manifest.path) # So the next run builds again
+      # End if
+      if (status is None):
+        sys.exit('ERROR: sphinx-build not found, not building')
+      elif (status != 0):
+        sys.exit('ERROR: sphinx-build failed (status %d)'%status)
+      # End if
+    else:
+      print("Nothing changed, not building")
+    # End if
+    print("Converted in %.2f s, built in %.2f s"%(convert_end - start,
+                                                  time.time() - convert_end))
+  # End if
+  return manifest
+# End def _convert_project
+
+def _watch_project(args):
+  """Convert the book, then check its sources every args.watch_interval
+  seconds and convert it again whenever one of them is saved.
+
+  Conversions after the first are incremental (see _BuildManifest) so
+  only changed sources, and those depending on aliases whose definition
+  changed, are converted. The caches (aliases, DOCTYPE declarations)
+  stay loaded between conversions. Runs until interrupted.
+  """
+  manifest = None
+  changed = []
+  try:
+    while (True):
+      converted = []
+      written = set()
+      try:
+        manifest = _convert_project(args)
+        finished = time.time()
+        converted = manifest.converted
+        written = set(manifest.written)
+      except (SystemExit, ConversionError) as e:
+        if (isinstance(e, ConversionError)):
+          sys.stderr.write('%s\n'%e)
+        elif (isinstance(e.code, str)):
+          sys.stderr.write(e.code + '\n')
+        # End if
+        print("Conversion failed, waiting for changes")
+      # End try
+      args.incremental = True
+      saved = [ _x[1] for _x in changed if _x[1] is not None ]
+      if (len(saved) > 0):
+        # Latency from the last save to each output file written
+        for dest_file in converted:
+          if (os.path.normpath(dest_file) not in written):
+            print("Unchanged %s"%dest_file) # (see _merge_tree)
+          else:
+            # A linked image keeps the time of its source
+            when = os.path.getmtime(dest_file)
+            if (when < max(saved)):
+              when = finished
+            # End if
+            print("Wrote %s %.3f s after save"%(dest_file, when - max(saved)))
+          # End if
+        # End for
+      # End if
+      stamps = _source_stamps(args.docbook_source, manifest)
+      print("Watching %d sources (interrupt to stop)"%len(stamps))
+      changed = []
+      while (len(changed) == 0):
+        time.sleep(args.watch_interval)
+        current = _source_stamps(args.docbook_source, manifest)
+        changed = [ (_p, current.get(_p, (None,))[0]) for _p in
+                    sorted(set(stamps).union(current))
+                    if (stamps.get(_p) != current.get(_p)) ]
+      # End while
+      for (path, mtime) in changed:
+        print("Changed ",path)
+      # End for
+    # End while
+  except KeyboardInterrupt:
+    print("Stopped watching")
+  # End try
+# End def _watch_project
+
+def _source_stamps(docbook_source, manifest):
+  # Return { path : (mtime, size) } for the sources of a book
+  paths = set()
+  if (docbook_source is not None):
+    paths.add(os.path.abspath(docbook_source))
+  # End if
+  if (manifest is not None):
+    paths.update(manifest.documents.keys())
+  # End if
+  stamps = {}
+  for path in paths:
+    try:
+      stat = os.stat(path)
+      stamps[path] = (stat.st_mtime, stat.st_size)
+    except OSError:
+      stamps[path] = (None, None) # Missing (e.g., not saved yet)
+    # End try
+  # End for
+  return stamps
+# End def _source_stamps
+
+def _convert_book(args):
+  doctype_cache = None
+  if (not args.no_doctype_cache):
+    doctype_cache = args.doctype_cache
+  # End if
+  converter = Converter(parser=args.parser, doctype_cache=doctype_cache,
+                        memo_size=args.memo_size)
+  if ((args.docbook_source is not None) and os.path.exists(args.docbook_source)):
+    xref_cache = None
+    if (not args.no_xref_cache):
+      xref_cache = args.xref_cache
+    # End if
+    converter.xrefs = _XrefIndex(args.docbook_source, xref_cache)
+    converter.image_root = os.path.dirname(os.path.abspath(args.docbook_source))
+  # End if
 
   # Create an argument list for a call to sphinx-quickstart
   sqsargs = [ 'sphinx-quickstart' ]
@@ -165,445 +465,3213 @@ e')
     sqsargs.append('--use-make-mode')
   # End if
 
-  # Remove the project directory if it exists
-  try:
-    if (os.path.exists(args.destination)):
-      print("Removing ",args.destination)
-      shutil.rmtree(args.destination)
+  # With --build, unchanged outputs are kept so Sphinx only reads those
+  # which change
+  manifest = _BuildManifest(args.destination, sqsargs,
+                            load=(args.incremental or args.build),
+                            parser=args.parser)
+  manifest.xrefs = converter.xrefs
+  if (manifest.valid):
+    print("Updating ",args.destination)
+  elif (args.reuse_scaffold and _has_scaffold(args.destination)):
+    print("Reusing scaffold in ",args.destination)
+  else:
+    # Remove the project directory if it exists (but keep what Sphinx
+    # built for --build)
+    builds = []
+    try:
+      if (os.path.exists(args.destination)):
+        if (args.build):
+          builds = _move_builds(args.destination)
+        # End if
+        print("Removing ",args.destination)
+        shutil.rmtree(args.destination)
+      # End if
+    except Exception as e:
+      print(e)
+    # End try
+    # Run sphinx-quickstart (or copy its output from a previous run)
+    if (args.no_scaffold_cache):
+      _quickstart(sqsargs, None)
+    else:
+      _quickstart(sqsargs, args.scaffold_cache)
     # End if
-  except Exception as e:
-    print(e)
-  # End try
-  # Run sphinx-quickstart
-  subprocess.check_call(sqsargs)
+    for (moved, build) in builds:
+      if (os.path.isdir(build)):
+        shutil.rmtree(build) # (an empty one from sphinx-quickstart)
+      # End if
+      os.rename(moved, build)
+      os.rmdir(os.path.dirname(moved))
+    # End for
+  # End if
 
   # Read in the main document (if specified)
   if ((args.docbook_source is not None) and os.path.exists(args.docbook_source)):
     dst_path = os.path.join(args.destination, 'source')
-    subdocs = _translate_docbook_source(args.docbook_source, dst_path,
-                                        aliases, master=True)
-    while (len(subdocs) > 0):
-      doc = subdocs.pop(0)
-      subdoc = doc[1]
-      if (not os.path.exists(subdoc)):
-        trysub = os.path.join(os.path.dirname(args.docbook_source), subdoc)
-        if (os.path.exists(trysub)):
-          print('Replacing "%s" with "%s"'%(subdoc,trysub))
-          subdoc = trysub
-        else:
-          _error('Referenced sub-document, "%s", is not found'%subdoc)
-        # End if
+    _convert_documents(args.docbook_source, dst_path, converter, args.jobs,
+                       manifest, args.prefetch, args.shard_lines,
+                       args.copy_jobs)
+  # End if
+  manifest.save()
+  return manifest
+# End def _convert_book
+
+def _convert_batch(parser, manifest, jobs=1):
+  """Convert the books listed in manifest in this process (or in a pool
+  of jobs processes) and report the time taken for each.
+
+  Each non-blank line of manifest holds the command line arguments for
+  one book, quoted as for a shell. Lines starting with # are comments.
+  """
+  books = []
+  with open(manifest) as mf:
+    for (linenum, line) in enumerate(mf, 1):
+      if ((len(line.strip()) == 0) or line.lstrip().startswith('#')):
+        continue
       # End if
-      subdocs.extend(_translate_docbook_source(subdoc, dst_path, aliases))
+      try:
+        args = parser.parse_args(shlex.split(line))
+      except SystemExit:
+        parser.error('cannot parse line %d of %s'%(linenum, manifest))
+      # End try
+      if ((args.project is None) or (args.batch is not None)):
+        parser.error('line %d of %s is not a book'%(linenum, manifest))
+      # End if
+      books.append(args)
+    # End for
+  # End with
+  start = time.time()
+  if (jobs > 1):
+    # Pool workers cannot start pools of their own
+    for args in books:
+      args.jobs = 1
     # End for
+    pool = multiprocessing.Pool(jobs)
+    try:
+      results = []
+      for result in pool.imap(_batch_task, books):
+        status, seconds, output, errors = result
+        sys.stdout.write(output)
+        sys.stderr.write(errors)
+        results.append((status, seconds))
+      # End for
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+    # End try
+  else:
+    results = [ _timed_project(args) for args in books ]
   # End if
-# End def _main
+  elapsed = time.time() - start
+  print('%-24s %-32s %10s %s'%('Project', 'Destination', 'Seconds', 'Status'))
+  for (args, (status, seconds)) in zip(books, results):
+    print('%-24s %-32s %10.2f %s'%(args.project, args.destination, seconds,
+                                   status))
+  # End for
+  print('%-24s %-32s %10.2f'%('Total (%d books)'%len(books), '', elapsed))
+  failed = [ _x for _x in results if _x[0] != 'ok' ]
+  if (len(failed) > 0):
+    sys.exit('ERROR: %d of %d books failed'%(len(failed), len(books)))
+  # End if
+# End def _convert_batch
 
-def _fl_out(tipe, linenum, filename):
-  sys.stderr.write('%s: line %d of %s'%(tipe, linenum, filename))
-# End def _fl_out
+def _timed_project(args):
+  # Convert one book of a batch, return its status and conversion time
+  start = time.time()
+  status = 'ok'
+  try:
+    _convert_project(args)
+  except ConversionError as e:
+    sys.stderr.write('%s\n'%e)
+    status = 'failed'
+  except SystemExit as e:
+    if (isinstance(e.code, str)):
+      sys.stderr.write(e.code + '\n')
+    # End if
+    status = 'failed'
+  except Exception:
+    traceback.print_exc()
+    status = 'failed'
+  # End try
+  return status, time.time() - start
+# End def _timed_project
 
-def _warn(s, linenum, filename):
-  _fl_out('WARNING', linenum, filename)
-  sys.stderr.write(": %s\n" % s)
-# End def _warn
+def _batch_task(args):
+  # Convert one book of a batch in a pool worker, console output is
+  # captured for the caller
+  stdout, stderr = sys.stdout, sys.stderr
+  sys.stdout, sys.stderr = StringIO(), StringIO()
+  try:
+    status, seconds = _timed_project(args)
+  finally:
+    output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+    sys.stdout, sys.stderr = stdout, stderr
+  # End try
+  return status, seconds, output, errors
+# End def _batch_task
 
-def _error(s, linenum, filename):
-  _fl_out('ERROR', linenum, filename)
-  sys.stderr.write(": %s\n" % s)
-  exit()
-# End def _error
+def _default_cache(kind):
+  # The default directory for cached kind (e.g., scaffolds)
+  cache = os.environ.get('XDG_CACHE_HOME', os.path.join('~', '.cache'))
+  return os.path.join(os.path.expanduser(cache), 'db2rst', kind)
+# End def _default_cache
 
-def _warn_single_tag(tag, ntags, linenum, filename):
-  if (ntags > 1):
-    _warn("<%s> should on line by itself, ignoring other tags\n" % tag,
-          linenum, filename)
-  # End if
-# End def _warn_single_tag
+def _move_builds(destination):
+  # Move the Sphinx build directories (build or _build) of project
+  # destination out of it, return [ (where it is now, where it was) ]
+  builds = []
+  for name in ('build', '_build'):
+    build = os.path.join(destination, name)
+    if (os.path.isdir(build)):
+      tmpdir = tempfile.mkdtemp(prefix='.db2rst',
+                                dir=os.path.dirname(os.path.abspath(destination)))
+      os.rename(build, os.path.join(tmpdir, name))
+      builds.append((os.path.join(tmpdir, name), build))
+    # End if
+  # End for
+  return builds
+# End def _move_builds
 
-def _translate_string(str, strtags, aliases, section, indent, linenum, filename):
-  global lastSect
-  indents   = [ '<note>' ]
-  unindents = [ '/note' ]
-  # Looking for tags and other syntax to translate from docbook to ReST
+def _has_scaffold(destination):
+  # Does destination hold sphinx-quickstart output (with or without --sep)?
+  return (os.path.exists(os.path.join(destination, 'conf.py')) or
+          os.path.exists(os.path.join(destination, 'source', 'conf.py')))
+# End def _has_scaffold
+
+def _quickstart(sqsargs, cache_dir):
+  """Create the scaffold for sphinx-quickstart command sqsargs.
 
-  for trigger in stringsubs.keys():
-    if (str.find(trigger) >= 0):
-      str = stringsubs[trigger].join(str.split(trigger))
-      if (trigger in indents):
-        indent = indent+'  '
+  Scaffolds are cached in cache_dir keyed on the quickstart arguments
+  (except the destination), the sphinx-quickstart executable and the
+  year (conf.py has a copyright year). A cached scaffold is copied into
+  place instead of running sphinx-quickstart again. If cache_dir is
+  None, sphinx-quickstart is always run.
+  """
+  destination = sqsargs[1]
+  executable = which(sqsargs[0])
+  if ((cache_dir is None) or (executable is None)):
+    subprocess.check_call(sqsargs) # Lets this report any problem
+    return
+  # End if
+  stat = os.stat(executable)
+  key = json.dumps([ sqsargs[2:], os.path.realpath(executable),
+                     stat.st_size, stat.st_mtime, time.localtime().tm_year ])
+  cached = os.path.join(cache_dir,
+                        hashlib.sha1(key.encode('utf-8')).hexdigest())
+  if (os.path.isdir(cached)):
+    print("Copying cached scaffold ",cached)
+    shutil.copytree(cached, destination)
+  else:
+    subprocess.check_call(sqsargs)
+    try:
+      # Copy then rename so a concurrent run never sees a partial scaffold
+      if (not os.path.isdir(cache_dir)):
+        os.makedirs(cache_dir)
       # End if
+      tmpdir = tempfile.mkdtemp(prefix='.new', dir=cache_dir)
+      shutil.copytree(destination, os.path.join(tmpdir, 'scaffold'))
+      os.rename(os.path.join(tmpdir, 'scaffold'), cached)
+      os.rmdir(tmpdir)
+    except (IOError, OSError) as e:
+      print("Not caching scaffold: ",e)
+    # End try
+  # End if
+# End def _quickstart
+
+def _sphinx_build(destination, jobs='auto'):
+  # Build the HTML for the project in destination (as make html would)
+  # with jobs processes, return the status of sphinx-build (None if it
+  # is not found). sphinx-build only reads sources changed (in time)
+  # since its last build.
+  executable = which('sphinx-build')
+  if (executable is None):
+    return None
+  # End if
+  source = os.path.join(destination, 'source')
+  build = os.path.join(destination, 'build')
+  if (not os.path.exists(os.path.join(source, 'conf.py'))):
+    source = destination
+    build = os.path.join(destination, '_build')
+  # End if
+  return subprocess.call([ executable, '-M', 'html', source, build,
+                          '-j', str(jobs) ])
+# End def _sphinx_build
+
+def _find_subdoc(doc, docbook_source):
+  # Return the path to sub-document doc or None if it cannot be found
+  subdoc = doc[1]
+  if (not os.path.exists(subdoc)):
+    subdoc = os.path.join(os.path.dirname(docbook_source), subdoc)
+    if (not os.path.exists(subdoc)):
+      subdoc = None
     # End if
-  # End for
+  # End if
+  return subdoc
+# End def _find_subdoc
 
-  if (aliases is not None):
-    for trigger in aliases.keys():
-      if (str.find(trigger) >= 0):
-        str = aliases[trigger].join(str.split(trigger))
-      # End if
-    # End for
+def _subdoc_found(doc, subdoc):
+  # Report how sub-document doc was found (or that it was not)
+  if (subdoc is None):
+    _error('Referenced sub-document, "%s", is not found'%doc[1],
+           doc[2], doc[3])
+  elif (subdoc != doc[1]):
+    print('Replacing "%s" with "%s"'%(doc[1],subdoc))
   # End if
+# End def _subdoc_found
 
-  if (strtags is not None):
-    for tag in strtags:
-      if (tag[0] in sectMarkers.keys()):
-        lastSect = tag[0]
-        print("lastSect = {0}".format(lastSect))
-        if (tag[1] != 'id'):
-          _error('%s tag with missing id'%tag[0], linenum, filename)
-        # End if
-        sectID = tag[2]
-        # Assume entire line is section tag and remove it (add blank lines)
-        str = "\\n.. _"+_strip_quotes(sectID)+":\\n"
+def _convert_documents(docbook_source, dst_path, converter, jobs=1,
+                       manifest=None, prefetch=0, shard_lines=0, copy_jobs=4):
+  """Convert docbook_source and the sub-documents it declares, in order.
+
+  Documents are converted breadth first into a work directory and moved
+  into dst_path in order. With more than one job, sub-documents are
+  converted in a process pool assuming they start with the aliases and
+  section state left by the documents already converted. A document
+  whose actual starting state differs is converted again so the output
+  is the same as a serial run. Documents which manifest shows are up to
+  date are not converted at all. A serial conversion with prefetch > 0
+  reads that many documents ahead and writes in the background (see
+  _IOPipeline). With more than one job, a document of more than
+  shard_lines lines (if not 0) is split into shards converted in the
+  pool (see _convert_sharded). The images the documents refer to are
+  then copied into dst_path by copy_jobs threads (see _AssetCopier).
+  """
+  global _pipeline, _source_digests
+  aliases = converter.aliases
+  workdir = tempfile.mkdtemp(prefix='.db2rst', dir=os.path.dirname(dst_path))
+  _source_digests = {} # (before the pool starts, so its workers have one)
+  pool = None
+  if (jobs > 1):
+    pool = multiprocessing.Pool(jobs)
+  elif (prefetch > 0):
+    _pipeline = _IOPipeline(prefetch)
+  # End if
+  copier = _AssetCopier(dst_path, manifest, copy_jobs, converter.image_root)
+  written = [] # Outputs and images replaced
+  taskids = itertools.count()
+  pending = []
+  plans = {} # Source file -> _shard_plan for the documents to split
+  def submit(doc, src_file, master=False):
+    # Queue src_file, starting its conversion (assuming the current
+    # state) if there is a pool and it is not up to date
+    digest = None
+    if ((pool is not None) and (manifest is not None) and
+        (src_file is not None) and os.path.exists(src_file)):
+      digest = _source_hash(src_file) # (passed on for the DOCTYPE cache)
+    # End if
+    task = (src_file, os.path.join(workdir, str(next(taskids))),
+            list(aliases.history), converter.section, master,
+            converter.options(), digest)
+    result = None
+    if ((pool is not None) and (src_file is not None) and
+        ((manifest is None) or
+         (manifest.lookup(src_file, master, task[2], task[3]) is None))):
+      if ((shard_lines > 0) and (converter.parser == 'line') and
+          (src_file not in plans) and os.path.exists(src_file)):
+        plans[src_file] = _shard_plan(src_file, shard_lines, 2 * jobs)
+      # End if
+      if (plans.get(src_file) is None):
+        result = pool.apply_async(_convert_task, (task,))
+      # End if
+    # End if
+    pending.append((doc, task, result))
+  # End def submit
+  try:
+    submit(None, docbook_source, master=True)
+    while (len(pending) > 0):
+      doc, task, result = pending.pop(0)
+      if (_pipeline is not None):
+        _pipeline.prefetch([ task[0] ] + [ _x[1][0] for _x in pending ])
+      # End if
+      if (doc is not None):
+        _subdoc_found(doc, task[0])
       # End if
-      if (tag[0] == 'title'):
-        if (lastSect is None):
-          _error('<title>tag with no preceding section tag', linenum, filename)
+      history = list(aliases.history)
+      record = None
+      if (manifest is not None):
+        record = manifest.lookup(task[0], task[4], history, converter.section)
+      # End if
+      if (record is None):
+        if (plans.get(task[0]) is not None):
+          task = (task[0], task[1], history, converter.section) + task[4:]
+          result = _convert_sharded(task, pool, plans[task[0]])
+        elif ((result is None) or (task[2] != history) or
+              (task[3] != converter.section)):
+          task = (task[0], task[1] + 'r', history,
+                  converter.section) + task[4:]
+          if (pool is None):
+            result = _convert_task(task)
+          else:
+            result = pool.apply_async(_convert_task, (task,)).get()
+          # End if
+        else:
+          result = result.get()
         # End if
-        str = ''.join(str.strip().split('<title>'))
-        if (lastSect in overbarSect):
-          str = sectMarkers[lastSect]+'\n'+str.strip()
+        (newdocs, added, section, outfile, output, errors, status, lookups,
+         profile) = result
+        if (_profile is not None):
+          _profile.merge(profile)
         # End if
-      # End if
-      if (tag[0] == '/title'):
-        if (lastSect is None):
-          _error('</title>tag with no preceding section tag', linenum, filename)
+        sys.stdout.write(output)
+        sys.stderr.write(errors)
+        if (_pipeline is not None):
+          _pipeline.merge(task[1], dst_path)
+        else:
+          written.extend(_merge_tree(task[1], dst_path))
         # End if
-        str = ''.join(str.strip().split('</title>'))
-        str = str.strip()+'\n'+sectMarkers[lastSect]
-        lastSect = None
+        dest_file = os.path.join(dst_path, os.path.relpath(outfile, task[1]))
+        if ((status is not None) and (status[0] == 'raise')):
+          raise status[1]
+        elif ((status is not None) and (status[0] == 'exit')):
+          sys.exit(status[1])
+        elif (status is not None):
+          sys.stderr.write(status[1])
+          sys.exit('ERROR: converting %s failed'%task[0])
+        # End if
+        if (manifest is not None):
+          manifest.record(task[0], task[4], history, converter.section, lookups,
+                          added, section, newdocs, dest_file)
+        # End if
+      else:
+        newdocs = record['subdocs']
+        added = record['added']
+        section = record['end_section']
+        lookups = record['lookups']
       # End if
-      if (tag[0] in unindents):
-        str = ''.join(str.strip().split('<'+tag[0]+'>'))
-        indent = indent[0:len(indent)-2]
+      copier.add(task[0], lookups)
+      for (key, value) in added:
+        aliases.add_alias(key, value)
+      # End for
+      converter.section = section
+      for newdoc in newdocs:
+        submit(newdoc, _find_subdoc(newdoc, docbook_source))
+      # End for
+    # End while
+    if (pool is not None):
+      pool.close()
+    # End if
+    written.extend(copier.copy())
+  finally:
+    if (pool is not None):
+      pool.terminate()
+      pool.join()
+    # End if
+    try:
+      if (_pipeline is not None):
+        _pipeline.close() # Finish the writes before the work area goes
+        written.extend(_pipeline.merged)
       # End if
-    # End for
+    finally:
+      _pipeline = None
+      _source_digests = None
+      shutil.rmtree(workdir)
+    # End try
+  # End try
+  if (manifest is not None):
+    manifest.written.extend(written)
   # End if
+# End def _convert_documents
 
-  return str.strip(), section, indent
-# End def _translate_string
+class _IOPipeline(object):
+  """Overlap the file system waits of a serial conversion with converting.
 
-def _set_postline(tags, linenum, filename):
-  postline = None
-  for tag in tags:
-    if (tag in sectMarkers.keys()):
-      _warn_single_tag(tag, len(tags), linenum, filename)
-      postline = sectMarkers[tag]
-      break
-    # End if
-  # End for
-  return postline
-# End def _set_postline
+  Sources are read ahead (up to depth documents, each in its own thread)
+  into memory. Output files, and moving each document's outputs into
+  place, are queued (at most depth) for one writer thread which does
+  them in order. Conversion itself stays in the calling thread, in the
+  same order, so the output is the same.
+  """
 
-def _translate_filename(filename, dest_path, remove_old = False):
-  # Strip .xml ending if it is there
-  fname = filename.rsplit('.', 1)
-  if (fname[1] == 'xml' or fname[1] == 'XML'):
-    filename = fname[0]
-  # No else because if the ending is not .xml, just leave it alone
-  # End if
-  filename += '.rst'
-  dest_file = os.path.join(dest_path, filename)
-  if (remove_old and os.path.exists(dest_file)):
-    os.remove(dest_file)
-  # End if
-  try:
-    os.makedirs(os.path.dirname(dest_file), 0755 )
-  except OSError:
-    pass # Probably only get here if directory already exists
-  return dest_file
-# End def _translate_filename
+  def __init__(self, depth):
+    self.depth = depth
+    self._reads = {} # Absolute path => [thread, data, SHA-1, error]
+    self._queue = queue.Queue(depth)
+    self._error = None # The first write error
+    self.merged = [] # Files replaced by the merges (see _merge_tree)
+    self._writer = threading.Thread(target=self._write_all)
+    self._writer.daemon = True
+    self._writer.start()
+  # End def __init__
 
-def _translate_docbook_source(src_file, dest_path, alias_list, master=False):
-  subdocs = [] # Cannot use dictionary because order matters
-  filename = os.path.basename(src_file)
-  inDOCTYPE = False
-  inBook = False
-  linenum = 0
-  dest_file = _translate_filename(filename, dest_path, True)
-  linein = ''
-  indent = ''
-  with open(src_file, "rU") as sf, open(dest_file, "w+") as df:
-    for line in sf:
-      linein += " " + line.strip()
-      linenum = linenum + 1
-      lineout = None
-      section = None
-      linein, ltags = _complete_line(linein, linenum, filename)
-      if ((ltags is not None) or 
-          (doctypeRE.match(linein.strip()) is not None) or
-          (linein.strip().find(']>') > -1)):
-        if (ltags is None):
-          ltags = []
-        # End if
-        etags = [ _x[0] for _x in ltags ]
-        if (doctypeRE.search(linein) is not None):
-          if (inDOCTYPE):
-            _error('Nested DOCTYPE tags', linenum, filename)
-          else:
-            inDOCTYPE = True
-            linein = '' # Ignore this line
-          # End if
-        elif (inDOCTYPE):
-          # Here, we only process !ENTITY tags
-          if ('!ENTITY' in etags):
-            _warn_single_tag('!ENTITY', len(etags), linenum, filename)
-            entag = [ _x for _x in ltags if _x[0] == '!ENTITY' ][0]
-            if (len(entag) < 2):
-              _warn('Malformed !ENTITY tag', linenum, filename)
-            elif ((len(entag) > 3) and (entag[2] == 'SYSTEM')):
-              # We have a new subdoc but it may be a partial path
-              subdocs.append((entag[1], _strip_quotes(entag[3])))
-            elif (len(entag) > 2):
-              # Treat this as an alias
-              newkey = "&" + entag[1] + ";"
-              alias_list[newkey] = _strip_quotes(_translate_string(entag[2], None, None, None, indent, linenum, filename)[0])
-            # End if
-          elif ((len(ltags) == 0) and (linein.find(']>') >= 0)):
-            inDOCTYPE = False
-          else:
-            if (len(linein.strip()) > 0):
-              _warn('Unnkown line in DOCTYPE section', linenum, filename)
-            # End if
-          # End if
-          linein = '' # Always pretend we successfully handled this line (hack?)
-        elif ('book' in etags):
-          if (inBook):
-            _error('Nested book tags', linenum, filename)
-          else:
-            _warn_single_tag('book', len(etags), linenum, filename)
-            inBook = True
-            if (master) :
-              print(preamble, file=df)
-            # End if
-            linein = '' # Ignore this line
-            lineout = ''
-          # End if
-        elif ('/book' in etags):
-          if (not inBook):
-            _error('End book tag found before opening tag', linenum, filename)
-          else:
-            _warn_single_tag('/book', len(etags), linenum, filename)
-            inBook = False
-          # End if
-          linein = ''
-        elif (inBook):
-          cmatch = codeItemRE.search(linein)
-          if (cmatch is not None):
-            # Insert doc here
-            filesym = cmatch.group(1)
-            # Find the filename for filesym
-            fmatch = [ _x[1] for _x in subdocs if _x[0] == filesym ]
-            if (len(fmatch) > 0):
-              sub_file = _translate_filename(fmatch[0], dest_path, True)
-              sub_file = os.path.basename(sub_file)
-              lineout = '   ' + sub_file
-            # End if
-          else:
-            lineout, section, newindent = _translate_string(linein, ltags, alias_list, section, indent, linenum, filename)
-          # End if
-          linein = '' # Assume line handled successfully
-        else:
-          lineout, section, newindent = _translate_string(linein, ltags, alias_list, section, indent, linenum, filename)
-          linein = '' # Assume line handled successfully
-        # End if (line match)
-      else: # just add in next line
-        pass
-      # End if (not incomplete line)
-      if (lineout is not None):
-        print(indent+'\n'.join(lineout.split('\\n')), file=df)
-        lineout = None
-        linein = ''
-        indent = newindent
+  def prefetch(self, paths):
+    # Start reading the first depth paths (if not already read)
+    for path in paths[0:self.depth]:
+      if ((path is not None) and (os.path.abspath(path) not in self._reads)):
+        read = [ threading.Thread(target=self._read, args=(path,)),
+                 None, None, None ]
+        read[0].daemon = True
+        self._reads[os.path.abspath(path)] = read
+        read[0].start()
       # End if
     # End for
-  # End with
-  return subdocs
-# End def _translate_docbook_source
+  # End def prefetch
 
-def _strip_quotes(string):
-  # Make sure this is a quoted string
-  strb = 0
-  stre = len(string) - 1
-  if (((string[strb] == '"') and (string[stre] == '"')) or
-      ((string[strb] == "'") and (string[stre] == "'"))):
-    return string[strb+1:stre]
-  else:
-    return string
-  # End if
-# End def _strip_quotes
+  def _read(self, path):
+    read = self._reads[os.path.abspath(path)]
+    try:
+      with open(path, 'rb', _io_buffer) as sf:
+        data = sf.read()
+      # End with
+      read[2] = hashlib.sha1(data).hexdigest()
+      # Universal newlines, as for open(path, "rU")
+      read[1] = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    except (IOError, OSError) as e:
+      read[3] = e # Opening path again reports the problem
+    # End try
+  # End def _read
 
-def _find_strings(line):
-  locs = list()
-  in_s_string = False
-  in_l_string = False
-  index = 0
+  def _wait(self, path):
+    # Return the finished read of path (or None)
+    read = self._reads.get(os.path.abspath(path))
+    if (read is not None):
+      read[0].join()
+    # End if
+    return read
+  # End def _wait
 
-  while (index < len(line)):
-    if (in_s_string):
-      if (line[index] == "'"):
-        in_s_string = False
-        locs.append((lb, index))
-      # End if
-    elif (in_l_string):
-      if (line[index] == '"'):
-        in_l_string = False
-        locs.append((lb, index))
-      # End if
-    else:
-      if (line[index] == "'"):
-        in_s_string = True
-        lb = index
-      elif (line[index] == '"'):
-        in_l_string = True
-        lb = index
-      # No else
-      # End if
+  def digest(self, path):
+    # Return the SHA-1 hex digest of path if it was read ahead (or None)
+    read = self._wait(path)
+    return None if read is None else read[2]
+  # End def digest
+
+  def take(self, path):
+    # Return (once) the contents of path if it was read ahead (or None)
+    read = self._wait(path)
+    if (read is None):
+      return None
     # End if
-    index = index + 1
-  # End while
+    data, read[1] = read[1], None
+    return data
+  # End def take
 
-  return locs, (in_s_string or in_l_string)
-# End def _find_strings
+  def write(self, path, texts):
+    # Queue writing texts to path
+    self._put(('write', path, texts))
+  # End def write
 
-def _in_string(start, end, locs):
-  send = -1
+  def merge(self, src_dir, dst_dir):
+    # Queue moving the files in src_dir into dst_dir (see _merge_tree)
+    self._put(('merge', src_dir, dst_dir))
+  # End def merge
 
-  for (ls, le) in locs:
-    if ((ls <= start) and (le >= end)):
-      send = le
-      break
+  def _put(self, item):
+    if (self._error is not None):
+      raise self._error
     # End if
-  # End for
+    self._queue.put(item)
+  # End def _put
 
-  return send
-# End def _in_string
+  def close(self):
+    # Wait for the queued writes, raise the first write error (if any)
+    self._queue.put(None)
+    self._writer.join()
+    self._reads = {}
+    if (self._error is not None):
+      raise self._error
+    # End if
+  # End def close
 
-def _read_tags(line, linenum, filename):
-  tags = []
-  index = 0
-  inds = len(line)
-  inde = -1
-  # First, we need to know where the strings are
-  string_locs, incomplete = _find_strings(line)
-  level = -1 if incomplete else 0
-  while(index < len(line)):
-    str_end = _in_string(index, index, string_locs)
-    if (str_end > -1):
-      index = str_end
-    elif (line[index] == '<'):
-      if (level == 0):
-        inds = index + 1
-      # End if
-      level = level + 1
-    elif (line[index] == '>'):
-      level = level - 1
-      if (level == 0):
-        inde = index
-        if (inds < inde):
-          newtag = list()
-          # Note, there could be spaces inside a string
-          tagb = inds
-          for (strb, stre) in string_locs:
-            # Is there stuff before this string (there should be before first)
-            if ((strb >= inds) and (stre <= inde)):
-              if (tagb < strb):
-                tage = strb - 1
-                newtag.extend(line[tagb:tage].strip().split(" "))
-              # End if
-              # Append string
-              newtag.append(line[strb:stre+1])
-              tagb = stre + 1
-            # End if
-          # End for
-          if (inde > tagb):
-            newtag.extend(line[tagb:inde].strip().split(" "))
-          # End if
-          if (newtag[0] in ignore_tags):
-            # We need to pretend this whole tag isn't there
-            line = line[0:inds-1].rstrip() + " "
-            index = len(line)
-            line = line + line[inde+1:].lstrip()
-          else:
-            # Remove empty newtag elements, then append
-            newtag = [ _x for _x in newtag if len(_x) > 0]
-            tags.append(newtag)
-            index = inde
-          # End if
-          inds = len(line)
-          inde = -1
+  def _write_all(self):
+    while (True):
+      item = self._queue.get()
+      if (item is None):
+        break
+      elif (self._error is not None):
+        continue # Skip the rest after an error
+      # End if
+      try:
+        if (item[0] == 'write'):
+          with open(item[1], "w+", _io_buffer) as df:
+            df.writelines(item[2])
+          # End with
         else:
-          _error('Internal Error?', linenum, filename)
+          self.merged.extend(_merge_tree(item[1], item[2]))
         # End if
-      # No else, this is an embedded tag close
+      except Exception as e:
+        self._error = e
+      # End try
+    # End while
+  # End def _write_all
+# End class _IOPipeline
+
+def _open_source(path):
+  # Open source path for reading (from memory if it was read ahead)
+  data = None
+  if (_pipeline is not None):
+    data = _pipeline.take(path)
+  # End if
+  if (data is None):
+    return open(path, "rU", _io_buffer)
+  # End if
+  return contextlib.closing(_SourceIO(data))
+# End def _open_source
+
+def _merge_tree(src_dir, dst_dir):
+  # Move everything in src_dir into dst_dir, replacing existing files
+  # unless they are the same (which keep their time so sphinx-build does
+  # not read them again). Return the files of dst_dir replaced.
+  replaced = []
+  if (os.path.isdir(src_dir)):
+    for (dirpath, dirnames, filenames) in os.walk(src_dir):
+      dstpath = os.path.join(dst_dir, os.path.relpath(dirpath, src_dir))
+      if (not os.path.isdir(dstpath)):
+        os.makedirs(dstpath, 0o755)
       # End if
-    # End if, just consume one more character
-    index = index + 1
-  # End while
+      for filename in filenames:
+        srcfile = os.path.join(dirpath, filename)
+        dstfile = os.path.join(dstpath, filename)
+        if (os.path.exists(dstfile)):
+          if (filecmp.cmp(srcfile, dstfile, shallow=False)):
+            os.remove(srcfile)
+            continue
+          # End if
+          os.remove(dstfile)
+        # End if
+        shutil.move(srcfile, dstfile)
+        replaced.append(os.path.normpath(dstfile))
+      # End for
+    # End for
+  # End if
+  return replaced
+# End def _merge_tree
 
-  return line, tags, (level != 0)
-# End def _read_tags
+class _AssetCopier(object):
+  """Copy the images referenced by a book's documents into its ReST
+  sources.
 
-def _incomplete_tags(tags, linenum, filename):
-  # We are only interested in tags which we need to process atomically.
-  tagopens = ('link', 'ulink', 'bookinfo')
-  tagcloses = [ '/'+_x for _x in tagopens ]
-  matches = {}
-  for pb in tagopens:
-    matches[pb] = True
-  # End for
-  for tag in tags:
-    if (tag[0] in tagopens):
-      if (matches[tag[0]]):
-        matches[tag[0]] = False
-      else:
-        _warn('open tag after close tag for %s?'%tag[0], linenum, filename)
+  A document records the fileref of each image as an 'image=' lookup
+  (see _image_tag), add collects them with the document's directory
+  (two different images with the same _asset_path are an error).
+  copy then puts each file at its _asset_path (from root, see
+  Converter.image_root) under dst_path with a pool of jobs threads. A
+  file is hard linked to its source where the file system allows. Otherwise files are hashed and those with the same
+  contents are copied only once (the others are links to the copy). A
+  file whose source has the size and modification time recorded in
+  manifest is not copied again.
+  """
+
+  pool_min = 64 # Fewer changed files are quicker without starting threads
+
+  def __init__(self, dst_path, manifest=None, jobs=4, root=None):
+    self.dst_path = dst_path
+    self.root = root
+    self.manifest = manifest
+    self.jobs = max(jobs, 1)
+    self.assets = {} # Path in dst_path -> (source, document)
+  # End def __init__
+
+  def add(self, src_file, lookups):
+    # Collect the images in the lookups of document src_file
+    srcdir = os.path.dirname(os.path.abspath(src_file))
+    for lookup in lookups:
+      if (lookup.startswith('image=')):
+        source = os.path.normpath(os.path.join(srcdir, lookup[6:]))
+        dest = os.path.join(self.dst_path,
+                            _asset_path(lookup[6:], srcdir, self.root))
+        first = self.assets.setdefault(dest, (source, src_file))
+        if ((first[0] != source) and
+            not (os.path.isfile(first[0]) and os.path.isfile(source) and
+                 filecmp.cmp(first[0], source, shallow=False))):
+          sys.exit('ERROR: %s would be both %s (%s) and %s (%s)'%
+                   (dest, first[0], os.path.basename(first[1]),
+                    source, os.path.basename(src_file)))
+        # End if
       # End if
-    elif (tag[0] in tagcloses):
-      if (matches[tag[0][1:]]):
-        _warn('close tag before open tag for %s?'%tag[0], linenum, filename)
+    # End for
+  # End def add
+
+  def copy(self):
+    # Copy (or link) the collected images, return the paths replaced
+    changed = [] # (dest, record) to copy
+    for (dest, (source, src_file)) in sorted(self.assets.items()):
+      try:
+        stat = os.stat(source)
+      except OSError:
+        sys.stderr.write('WARNING: image %s of %s not found\n'%
+                         (source, os.path.basename(src_file)))
+        continue
+      # End try
+      record = [ source, stat.st_mtime, stat.st_size, None ]
+      old = None
+      if (self.manifest is not None):
+        old = self.manifest.asset(dest)
+      # End if
+      if ((old is not None) and (old[0:3] == record[0:3]) and
+          os.path.exists(dest)):
+        record = old
       else:
-        matches[tag[0][1:]] = True
+        changed.append((dest, record))
+      # End if
+      if (self.manifest is not None):
+        self.manifest.record_asset(dest, record)
       # End if
+    # End for
+    pool = None
+    if ((self.jobs > 1) and (len(changed) >= self.pool_min)):
+      pool = multiprocessing.pool.ThreadPool(self.jobs)
     # End if
-  # End for
-  return (False in matches.values())
-# End def _incomplete_tags
-
-def _complete_line(line, linenum, filename):
-  tags = None
-  newline = line.strip()
-  if (len(newline) > 0):
-    locs, incomplete = _find_strings(newline)
-    if (not incomplete):
-      newline, tags, incomplete = _read_tags(newline, linenum, filename)
-      if (incomplete or _incomplete_tags(tags, linenum, filename)):
-        tags = None
-        newline = line.strip()
+    try:
+      mapper = map if (pool is None) else pool.map
+      copies = {} # SHA-1 -> [ (source, dest) ] to copy
+      for (dest, record) in mapper(self._link_source, changed):
+        if (record[3] is not None):
+          copies.setdefault(record[3], []).append((record[0], dest))
+        # End if
+      # End for
+      list(mapper(self._place, list(copies.values())))
+    finally:
+      if (pool is not None):
+        pool.terminate()
+        pool.join()
       # End if
+    # End try
+    if (self.manifest is not None):
+      self.manifest.converted.extend([ _x[0] for _x in changed ])
+    # End if
+    return [ os.path.normpath(_x[0]) for _x in changed ]
+  # End def copy
+
+  def _link_source(self, item):
+    # Link an asset to its source, if that is not possible put the
+    # SHA-1 of the source (to be copied, see _place) in its record
+    dest, record = item
+    if (not _link(record[0], dest)):
+      record[3] = _file_hash(record[0])
     # End if
+    return item
+  # End def _link_source
+
+  def _place(self, copies):
+    # Copy the first of files with the same contents, link the others
+    first = copies[0][1]
+    shutil.copy2(copies[0][0], first)
+    for (source, dest) in copies[1:]:
+      if (not _link(first, dest)):
+        shutil.copy2(source, dest) # No links at all
+      # End if
+    # End for
+  # End def _place
+# End class _AssetCopier
+
+def _asset_path(fileref, source_dir=None, root=None):
+  # Return the path (relative to the ReST sources) an image is copied
+  # to: its path relative to root (the book's directory, by default the
+  # document's, source_dir) so images in different directories never
+  # share a path. An image outside root goes to _assets/ under a short
+  # hash of its directory (relative to root).
+  path = fileref
+  if (source_dir is not None):
+    path = os.path.normpath(os.path.join(source_dir, fileref))
+    try:
+      path = os.path.relpath(path, source_dir if (root is None) else root)
+    except ValueError:
+      pass # (on another drive)
+    # End try
   # End if
-  return newline, tags
-# End def _complete_line
+  path = posixpath.normpath(path.replace('\\', '/'))
+  if (path.startswith('../') or (path == '..') or posixpath.isabs(path) or
+      (os.path.splitdrive(path)[0] != '')):
+    directory = posixpath.dirname(path)
+    digest = hashlib.sha1(directory.encode('utf-8')).hexdigest()[0:8]
+    path = '_assets/%s/%s'%(digest, posixpath.basename(path))
+  # End if
+  return path
+# End def _asset_path
+
+def _link(src, dst):
+  # Replace dst by a hard link to src, return False if that is not possible
+  if (not os.path.isdir(os.path.dirname(dst))):
+    try:
+      os.makedirs(os.path.dirname(dst), 0o755)
+    except OSError:
+      pass # Made by another thread
+    # End try
+  # End if
+  if (os.path.lexists(dst)):
+    os.remove(dst)
+  # End if
+  try:
+    os.link(src, dst)
+  except (OSError, AttributeError):
+    return False
+  # End try
+  return True
+# End def _link
+
+def _convert_task(task):
+  # Convert one document starting from the given alias history and
+  # section state (may run in a pool worker). Console output and any
+  # profile are captured for the caller.
+  global _profile
+  src_file, dest_path, history, section, master, options, digest = task
+  if ((digest is not None) and (_source_digests is not None)):
+    _source_digests[os.path.abspath(src_file)] = digest
+  # End if
+  profile = _profile
+  if (profile is not None):
+    _profile = _Profile()
+  # End if
+  stdout, stderr = sys.stdout, sys.stderr
+  sys.stdout, sys.stderr = StringIO(), StringIO()
+  subdocs = []
+  converter = Converter(_alias_engine(history), section, **options)
+  converter.aliases.lookups = set()
+  status = None
+  try:
+    subdocs = _translate_docbook_source(src_file, dest_path, converter,
+                                        master=master)
+  except ConversionError as e:
+    status = ('raise', e)
+  except SystemExit as e:
+    status = ('exit', e.code)
+  except Exception:
+    status = ('error', traceback.format_exc())
+  finally:
+    output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+    sys.stdout, sys.stderr = stdout, stderr
+    if (profile is not None):
+      profile, _profile = _profile.data(), profile
+    # End if
+  # End try
+  outfile = _translate_filename(os.path.basename(src_file), dest_path)
+  aliases = converter.aliases
+  return (subdocs, aliases.history[len(history):], converter.section, outfile,
+          output, errors, status, sorted(aliases.lookups), profile)
+# End def _convert_task
 
-# # Tags to simply ignore
-# keyword = _concat
-# keywordset = _concat
-# abstract = _concat
-# bookinfo = _concat
-# corpauthor = _concat
-# example = _concat
-# glossary = _concat
-# figure = _concat
-# computeroutput = userinput
-# literal = userinput
-# option = userinput
-# procedure = orderedlist
-# productname = emphasis
-# programlisting = screen
-# pubdate = emphasis
-# quote = userinput
-# simpara = _block_separated_with_blank_line
+_shardRE = re.compile(r"^\s*<sect[12][\s>]")
+_bookRE = re.compile(r"<(/?)book[\s>]")
+
+def _shard_plan(path, shard_lines, nshards):
+  """Return how to convert path in about nshards shards: a list of the
+  first line of each shard and whether it is predicted to be in the
+  book, and the last line of the DOCTYPE section (0 if none). None if
+  path has shard_lines lines or less, or cannot be split.
+
+  This is a quick scan of the raw lines, shards start on a line which
+  starts with a sect1 or sect2 tag (after the DOCTYPE section).
+  """
+  candidates = []
+  doctype = 0
+  inDOCTYPE = False
+  inBook = False
+  nlines = 0
+  with _open_source(path) as sf:
+    for line in sf:
+      nlines = nlines + 1
+      if ((not inDOCTYPE) and (doctype == 0) and
+          (doctypeRE.match(line) is not None)):
+        inDOCTYPE = True
+      # End if
+      if (inDOCTYPE):
+        if (line.find(']>') >= 0):
+          inDOCTYPE = False
+          doctype = nlines
+        # End if
+        continue
+      # End if
+      if (_shardRE.match(line) is not None):
+        candidates.append((nlines, inBook))
+      # End if
+      for match in _bookRE.finditer(line):
+        inBook = (match.group(1) == '')
+      # End for
+    # End for
+  # End with
+  if ((nlines <= shard_lines) or inDOCTYPE):
+    return None
+  # End if
+  size = nlines / float(max(nshards, 1))
+  shards = [ (1, False) ]
+  for (first, book) in candidates:
+    if (((first - shards[-1][0]) >= size) and
+        ((nlines - first) >= (size / 2))):
+      shards.append((first, book))
+    # End if
+  # End for
+  if (len(shards) < 2):
+    return None
+  # End if
+  return shards, doctype
+# End def _shard_plan
+
+def _shard_task(task):
+  # Convert the lines first to last (None for the end) of a document
+  # starting from the given alias history, section and _shard_state
+  # (may run in a pool worker). Returns as _convert_task but with the
+  # ReST text and the final _shard_state in place of the output file.
+  global _profile
+  (src_file, dest_path, first, last, history, section, state, master,
+   options) = task
+  profile = _profile
+  if (profile is not None):
+    _profile = _Profile()
+  # End if
+  stdout, stderr = sys.stdout, sys.stderr
+  sys.stdout, sys.stderr = StringIO(), StringIO()
+  converter = Converter(_alias_engine(history), section, **options)
+  converter.aliases.lookups = set()
+  converter.source_dir = os.path.dirname(os.path.abspath(src_file))
+  shard = dict(state, first=first)
+  text = []
+  status = None
+  try:
+    with _open_source(src_file) as sf:
+      lines = itertools.islice(sf, first - 1, last)
+      if (_profile is not None):
+        lines = _profile.count(src_file, lines)
+      # End if
+      for piece in _translate_lines(lines, converter,
+                                    os.path.basename(src_file), dest_path,
+                                    master, shard):
+        text.append(piece)
+      # End for
+    # End with
+  except ConversionError as e:
+    status = ('raise', e)
+  except SystemExit as e:
+    status = ('exit', e.code)
+  except Exception:
+    status = ('error', traceback.format_exc())
+  finally:
+    output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+    sys.stdout, sys.stderr = stdout, stderr
+    if (profile is not None):
+      profile, _profile = _profile.data(), profile
+    # End if
+  # End try
+  aliases = converter.aliases
+  return (converter.subdocs, aliases.history[len(history):],
+          converter.section, ''.join(text), shard.get('end'), output, errors,
+          status, sorted(aliases.lookups), profile)
+# End def _shard_task
+
+def _convert_sharded(task, pool, plan):
+  """Convert a document (task as for _convert_task) in the shards of
+  plan (see _shard_plan) in pool, return as _convert_task.
+
+  The shards after the first are converted assuming they start in the
+  state predicted by plan (with the aliases and sub-documents of the
+  DOCTYPE section, no section, no indent and no open list or caption).
+  Going through the results
+  in order, a shard whose actual starting state differs is converted
+  again, and one starting in the middle of a logical line is joined to
+  the shard before it, so the output is the same as converting the
+  whole document at once.
+  """
+  src_file, dest_path, history, section, master, options, digest = task
+  shards, doctype = plan
+  # The state after the DOCTYPE section
+  declared = (list(history), _shard_state())
+  if (doctype > 0):
+    result = _shard_task((src_file, dest_path, 1, doctype, history, section,
+                          _shard_state(), master, options))
+    if (result[7] is None):
+      declared = (list(history) + list(result[1]), result[4])
+    # End if
+  # End if
+  tasks = []
+  for (index, (first, inBook)) in enumerate(shards):
+    last = shards[index + 1][0] - 1 if (index + 1 < len(shards)) else None
+    if (index == 0):
+      state = (history, section, _shard_state())
+    else:
+      state = (declared[0], None, dict(declared[1], inBook=inBook,
+                                       indent='', verbatim=None,
+                                       inDOCTYPE=False, lists=[],
+                                       caption=None, pending=False))
+    # End if
+    tasks.append((src_file, dest_path, first, last) + state +
+                 (master, options))
+  # End for
+  results = [ pool.apply_async(_shard_task, (_x,)) for _x in tasks ]
+  subdocs, added, text, output, errors, lookups = [], [], [], [], [], set()
+  profile = _Profile() if (_profile is not None) else None
+  state = (list(history), section, _shard_state())
+  status = None
+  index = 0
+  while ((index < len(tasks)) and (status is None)):
+    shard = tasks[index]
+    if (shard[4:7] == state):
+      result = results[index].get()
+    else:
+      shard = shard[0:4] + state + shard[7:]
+      result = pool.apply_async(_shard_task, (shard,)).get()
+    # End if
+    while ((result[4] is not None) and result[4]['pending'] and
+           (index + 1 < len(tasks))):
+      # The next shard starts inside a logical line, join them
+      index = index + 1
+      shard = shard[0:3] + (tasks[index][3],) + shard[4:]
+      result = pool.apply_async(_shard_task, (shard,)).get()
+    # End while
+    (newdocs, newaliases, newsection, newtext, end, newoutput, newerrors,
+     status, newlookups, newprofile) = result
+    subdocs.extend(newdocs)
+    added.extend(newaliases)
+    text.append(newtext)
+    output.append(newoutput)
+    errors.append(newerrors)
+    lookups.update(newlookups)
+    if (newprofile is not None):
+      profile.merge(newprofile)
+    # End if
+    if (end is not None):
+      state = (state[0] + list(newaliases), newsection,
+               dict(end, pending=False))
+    # End if
+    index = index + 1
+  # End while
+  dest_file = _translate_filename(os.path.basename(src_file), dest_path, True)
+  with open(dest_file, "w+", _io_buffer) as df:
+    _write_text(df, text)
+  # End with
+  if (profile is not None):
+    profile = profile.data()
+  # End if
+  return (subdocs, added, state[1], dest_file, ''.join(output),
+          ''.join(errors), status, sorted(lookups), profile)
+# End def _convert_sharded
+
+def _alias_engine(history):
+  # Return a _SubstitutionEngine with the aliases in history added in order.
+  # Indexing many aliases is slow, so the engine is copied from one built
+  # for the longest known prefix of history (usually all of it).
+  history = [ tuple(_x) for _x in history ]
+  known, aliases = [], None
+  for (prefix, engine) in _alias_engines:
+    if ((len(known) <= len(prefix) <= len(history)) and
+        (history[0:len(prefix)] == prefix)):
+      known, aliases = prefix, engine
+    # End if
+  # End for
+  if (aliases is None):
+    aliases = _SubstitutionEngine()
+  else:
+    aliases = aliases.copy()
+  # End if
+  for (key, value) in history[len(known):]:
+    aliases.add_alias(key, value)
+  # End for
+  if (len(history) > len(known)):
+    _alias_engines.append((history, aliases.copy()))
+    del _alias_engines[0:-4] # Keep the last few
+  # End if
+  return aliases
+# End def _alias_engine
+
+def _file_hash(path):
+  # Return the SHA-1 hex digest of the contents of path
+  if (_pipeline is not None):
+    digest = _pipeline.digest(path)
+    if (digest is not None):
+      return digest
+    # End if
+  # End if
+  sha = hashlib.sha1()
+  with open(path, 'rb') as fh:
+    for block in iter(lambda: fh.read(1 << 16), b''):
+      sha.update(block)
+    # End for
+  # End with
+  return sha.hexdigest()
+# End def _file_hash
+
+def _source_hash(path):
+  # Return the SHA-1 hex digest of source path, read only once during a
+  # run of _convert_documents (for both the DOCTYPE cache and manifest)
+  if (_source_digests is None):
+    return _file_hash(path)
+  # End if
+  key = os.path.abspath(path)
+  if (key not in _source_digests):
+    _source_digests[key] = _file_hash(path)
+  # End if
+  return _source_digests[key]
+# End def _source_hash
+
+def _converter_hash():
+  # Return the SHA-1 hex digest of this converter (db2rst.py)
+  global _converter_sha
+  if (_converter_sha is None):
+    converter = __file__
+    if (converter.endswith('.pyc') or converter.endswith('.pyo')):
+      converter = converter[:-1]
+    # End if
+    _converter_sha = _file_hash(converter)
+  # End if
+  return _converter_sha
+# End def _converter_hash
+
+def _cached_doctype(path, cache_dir):
+  """Return (key, DOCTYPE declarations) for the source file path.
+
+  The declarations ({'start', 'end', 'events'}, see _translate_lines) are
+  looked up by the contents of path and this converter, in memory and
+  then in cache_dir. They are None if the file has not been read before.
+  """
+  key = hashlib.sha1((_converter_hash() + _source_hash(path)).encode('ascii')).hexdigest()
+  if (key not in _doctype_tables):
+    try:
+      with open(os.path.join(cache_dir, key + '.json')) as cf:
+        _doctype_tables[key] = _native(json.load(cf))
+      # End with
+    except (IOError, OSError, ValueError):
+      return key, None
+    # End try
+  # End if
+  return key, _doctype_tables[key]
+# End def _cached_doctype
+
+def _save_doctype(key, declared, cache_dir):
+  # Remember the DOCTYPE declarations read from a file (see _cached_doctype)
+  _doctype_tables[key] = declared
+  _save_cache(cache_dir, key, declared)
+# End def _save_doctype
+
+def _save_cache(cache_dir, key, data):
+  # Write data as cache_dir/key.json (if possible)
+  try:
+    # Write then rename so a concurrent run never sees a partial file
+    if (not os.path.isdir(cache_dir)):
+      os.makedirs(cache_dir)
+    # End if
+    fd, tmpname = tempfile.mkstemp(prefix='.new', dir=cache_dir)
+    with os.fdopen(fd, 'w') as cf:
+      json.dump(data, cf)
+    # End with
+    os.rename(tmpname, os.path.join(cache_dir, key + '.json'))
+  except (IOError, OSError, ValueError):
+    pass # The cache is only an optimization
+  # End try
+# End def _save_cache
+
+class _XrefIndex(object):
+  """Index of the section ids of a book (its master document and every
+  SYSTEM sub-document, recursively) for resolving link, xref and ulink.
+
+  ids maps each id of a chapter or sect1-3 element to its document (the
+  name of its output without suffix), title (as in the source) and
+  element name. docs maps the file names a ulink may use for a document
+  (source and HTML output) to the document's name and roots holds the id
+  of the first section element of each document (linked with :doc:).
+  The index is built by a quick scan of the raw text of each file, the
+  scan of a file is reused while its size and modification time do not
+  change (and kept in cache_dir between runs).
+  """
+
+  _entityRE = re.compile(r"<!ENTITY\s+(\S+)\s+SYSTEM\s+[\"']([^\"']*)[\"']")
+  _sectionRE = re.compile(r"<(%s)\s[^<>]*?\bid\s*=\s*[\"']([^\"']*)[\"'][^<>]*>"%
+                          '|'.join(sorted(sectMarkers.keys())))
+  _titleRE = re.compile(r"<title(?:\s[^<>]*)?>(.*?)</title\s*>", re.S)
+
+  def __init__(self, master, cache_dir=None):
+    self.ids = {}
+    self.docs = {}
+    self.roots = set()
+    files = {}
+    cache = None
+    if (cache_dir is not None):
+      key = hashlib.sha1((_converter_hash() +
+                          os.path.abspath(master)).encode('utf-8')).hexdigest()
+      cache = os.path.join(cache_dir, key + '.json')
+      try:
+        with open(cache) as cf:
+          files = _native(json.load(cf))
+        # End with
+      except (IOError, OSError, ValueError):
+        pass
+      # End try
+    # End if
+    found = [ master ]
+    scanned = {}
+    while (len(found) > 0):
+      path = os.path.abspath(found.pop(0))
+      if (path in scanned):
+        continue
+      # End if
+      scanned[path] = self.scan(path, files.get(path))
+      ids, subdocs = scanned[path]['ids'], scanned[path]['subdocs']
+      name = _rst_filename(os.path.basename(path))[:-4]
+      self.docs[os.path.basename(path)] = name
+      self.docs[name + '.html'] = name
+      for (index, (sectid, title, element)) in enumerate(ids):
+        self.ids.setdefault(sectid, (name, title, element))
+        if (index == 0):
+          self.roots.add(sectid)
+        # End if
+      # End for
+      for subdoc in subdocs:
+        subdoc = _find_subdoc(subdoc, master)
+        if (subdoc is not None):
+          found.append(subdoc)
+        # End if
+      # End for
+    # End while
+    if ((cache is not None) and (scanned != files)):
+      _save_cache(cache_dir, key, scanned)
+    # End if
+  # End def __init__
+
+  @classmethod
+  def scan(cls, path, cached=None):
+    # Return the ids ([id, title, element]) and sub-documents ([name,
+    # path]) of the file path, cached if its size and time are the same
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return { 'stamp' : None, 'ids' : [], 'subdocs' : [] }
+    # End try
+    stamp = [ stat.st_mtime, stat.st_size ]
+    for entry in (_xref_files.get(path), cached):
+      if ((entry is not None) and (entry['stamp'] == stamp)):
+        _xref_files[path] = entry
+        return entry
+      # End if
+    # End for
+    with open(path, 'rU') as sf:
+      text = sf.read()
+    # End with
+    ids = []
+    sections = list(cls._sectionRE.finditer(text))
+    for (index, match) in enumerate(sections):
+      end = len(text)
+      if (index + 1 < len(sections)):
+        end = sections[index + 1].start()
+      # End if
+      title = cls._titleRE.search(text, match.end(), end)
+      if (title is not None):
+        title = ' '.join(_markupRE.sub('', title.group(1)).split())
+      # End if
+      ids.append([ match.group(2), title, match.group(1) ])
+    # End for
+    subdocs = [ list(_x.groups()) for _x in cls._entityRE.finditer(text) ]
+    entry = { 'stamp' : stamp, 'ids' : ids, 'subdocs' : subdocs }
+    _xref_files[path] = entry
+    return entry
+  # End def scan
+
+  def resolve(self, lookup):
+    # Return the target of lookup ('linkend=' + an id or 'url=' + a URL):
+    # [role, target, title] or None if it is not in the book
+    if (lookup.startswith('linkend=')):
+      target = self.ids.get(lookup[8:])
+      if (target is None):
+        return None
+      elif (lookup[8:] in self.roots):
+        return [ 'doc', target[0], target[1] ]
+      # End if
+      return [ 'ref', lookup[8:], target[1] ]
+    elif (lookup.startswith('url=')):
+      url = lookup[4:].split('#', 1)[0]
+      if (url.find('://') < 0):
+        name = self.docs.get(os.path.basename(url))
+        if (name is not None):
+          return [ 'doc', name, None ]
+        # End if
+      # End if
+    # End if
+    return None
+  # End def resolve
+
+  def depends(self, lookups):
+    """Return the [lookup, target] of the links in lookups (see
+    _SubstitutionEngine.lookups), which a conversion depends on"""
+    return [ [ _x, self.resolve(_x) ] for _x in sorted(lookups)
+             if (_x.startswith('linkend=') or _x.startswith('url=')) ]
+  # End def depends
+# End class _XrefIndex
+
+def _native(obj):
+  # JSON strings load as unicode in Python 2, convert them back to str
+  if (isinstance(obj, dict)):
+    return dict([ (_native(_k), _native(_v)) for (_k, _v) in obj.items() ])
+  elif (isinstance(obj, list)):
+    return [ _native(_x) for _x in obj ]
+  elif ((str is bytes) and isinstance(obj, type(u''))):
+    return obj.encode('utf-8')
+  # End if
+  return obj
+# End def _native
+
+class _BuildManifest(object):
+  """Record of the documents converted into a destination.
+
+  For each source this keeps its content hash, the section state it
+  started with, the alias definitions it depends on and what converting
+  it produced (aliases added, sub-documents declared, output file).
+  The record is kept in the destination so that an incremental run can
+  skip sources for which none of those inputs have changed. A manifest
+  written by another version of this converter or for different
+  sphinx-quickstart arguments or parser does not match (valid is False).
+  Links are checked against xrefs (an _XrefIndex) so a source is also
+  converted again when the targets of its links change. The images
+  copied (see _AssetCopier) are recorded with their source's size and
+  modification time.
+  """
+
+  filename = '.db2rst-manifest.json'
+
+  def __init__(self, destination, sqsargs, load=True, parser='line'):
+    self.destination = destination
+    self.path = os.path.join(destination, self.filename)
+    self.key = { 'converter' : _converter_hash(),
+                 'sqsargs'   : list(sqsargs),
+                 'parser'    : parser }
+    self.documents = {}
+    self.converted = [] # Outputs converted (images copied) by this run
+    self.written = [] # Those actually replaced (the others were the same)
+    self.xrefs = None
+    self.assets = {} # Image copied (relative path) -> its record
+    self.valid = False
+    self._old = {}
+    self._old_assets = {}
+    self._hashes = {}
+    if (load and os.path.exists(self.path)):
+      try:
+        with open(self.path) as mf:
+          data = _native(json.load(mf))
+        # End with
+        if (data['key'] == self.key):
+          self._old = data['documents']
+          self._old_assets = data.get('assets', {})
+          self.valid = True
+        # End if
+      except (IOError, ValueError, KeyError, TypeError):
+        pass # A damaged manifest just means a full rebuild
+      # End try
+    # End if
+  # End def __init__
+
+  def _hash(self, src_file):
+    key = os.path.abspath(src_file)
+    if (key not in self._hashes):
+      self._hashes[key] = _source_hash(src_file)
+    # End if
+    return self._hashes[key]
+  # End def _hash
+
+  def lookup(self, src_file, master, history, section):
+    """Return the record for src_file if converting it again starting
+    with aliases history and section would produce the same result"""
+    record = self._old.get(os.path.abspath(src_file))
+    if ((record is None) or (record['master'] != master) or
+        (record['section'] != section) or
+        (not os.path.exists(os.path.join(self.destination,
+                                         record['output']))) or
+        (record['hash'] != self._hash(src_file))):
+      return None
+    # End if
+    added = [ tuple(_x) for _x in record['added'] ]
+    aliases = _alias_engine(history + added)
+    if (aliases.depends(record['lookups']) != record['depends']):
+      return None
+    # End if
+    if (self._xref_depends(record['lookups']) != record.get('xrefs', [])):
+      return None
+    # End if
+    self.documents[os.path.abspath(src_file)] = record
+    return { 'subdocs'     : [ tuple(_x) for _x in record['subdocs'] ],
+             'added'       : added,
+             'end_section' : record['end_section'],
+             'lookups'     : record['lookups'] }
+  # End def lookup
+
+  def record(self, src_file, master, history, section, lookups, added,
+             end_section, subdocs, dest_file):
+    """Record the conversion of src_file"""
+    aliases = _alias_engine(history + added)
+    self.converted.append(dest_file)
+    self.documents[os.path.abspath(src_file)] = {
+      'hash'        : self._hash(src_file),
+      'master'      : master,
+      'section'     : section,
+      'lookups'     : lookups,
+      'depends'     : aliases.depends(lookups),
+      'xrefs'       : self._xref_depends(lookups),
+      'added'       : [ list(_x) for _x in added ],
+      'end_section' : end_section,
+      'subdocs'     : [ list(_x) for _x in subdocs ],
+      'output'      : os.path.relpath(dest_file, self.destination) }
+  # End def record
+
+  def asset(self, dest_file):
+    """Return the record of image dest_file from the last run (or None)"""
+    return self._old_assets.get(os.path.relpath(dest_file, self.destination))
+  # End def asset
+
+  def record_asset(self, dest_file, record):
+    """Record the image dest_file ([source, mtime, size, SHA-1])"""
+    self.assets[os.path.relpath(dest_file, self.destination)] = record
+  # End def record_asset
+
+  def _xref_depends(self, lookups):
+    if (self.xrefs is None):
+      return []
+    # End if
+    return self.xrefs.depends(lookups)
+  # End def _xref_depends
+
+  def save(self):
+    """Remove outputs of sources no longer converted and write the manifest"""
+    outputs = set([ _x['output'] for _x in self.documents.values() ])
+    outputs.update(self.assets.keys())
+    old = [ _x['output'] for _x in self._old.values() ]
+    for output in old + list(self._old_assets.keys()):
+      stale = os.path.join(self.destination, output)
+      if ((output not in outputs) and os.path.exists(stale)):
+        print("Removing ",stale)
+        os.remove(stale)
+      # End if
+    # End for
+    if (os.path.isdir(self.destination)):
+      with open(self.path, 'w') as mf:
+        json.dump({ 'key' : self.key, 'documents' : self.documents,
+                    'assets' : self.assets }, mf, indent=1, sort_keys=True)
+      # End with
+    # End if
+  # End def save
+# End class _BuildManifest
+
+class _Profile(object):
+  """Calls and wall time for each conversion phase (see _instrument) and
+  the lines, bytes and time for each source file, for --profile.
+
+  Times are inclusive, e.g., complete_line includes read_tags.
+  """
+
+  phases = ( 'sphinx-quickstart', 'complete_line', 'read_tags',
+             'translate_string', 'substitute', 'write', 'copy images' )
+
+  def __init__(self):
+    self.start = _clock()
+    self.calls = {} # Phase name -> [calls, seconds]
+    self.files = {} # Source file -> [lines, bytes, seconds]
+    self.memo_counts = [0, 0] # _TranslationMemo [hits, misses]
+  # End def __init__
+
+  def add(self, phase, seconds):
+    entry = self.calls.get(phase)
+    if (entry is None):
+      self.calls[phase] = [1, seconds]
+    else:
+      entry[0] = entry[0] + 1
+      entry[1] = entry[1] + seconds
+    # End if
+  # End def add
+
+  def memo(self, hit):
+    # Count a _TranslationMemo lookup
+    index = 0 if hit else 1
+    self.memo_counts[index] = self.memo_counts[index] + 1
+  # End def memo
+
+  def count(self, src_file, lines):
+    # Generate lines, counting them into the entry for src_file
+    entry = self.files.setdefault(src_file, [0, 0, 0.0])
+    start = _clock()
+    for line in lines:
+      entry[0] = entry[0] + 1
+      entry[1] = entry[1] + len(line)
+      yield line
+    # End for
+    entry[2] = entry[2] + _clock() - start
+  # End def count
+
+  def data(self):
+    # The counts as (picklable, JSON) data
+    return { 'phases' : self.calls, 'files' : self.files,
+             'memo' : self.memo_counts }
+  # End def data
+
+  def merge(self, data):
+    # Add counts recorded by another _Profile (e.g., in a pool worker)
+    for (phase, (calls, seconds)) in data['phases'].items():
+      entry = self.calls.setdefault(phase, [0, 0.0])
+      entry[0] = entry[0] + calls
+      entry[1] = entry[1] + seconds
+    # End for
+    for (src_file, counts) in data['files'].items():
+      entry = self.files.setdefault(src_file, [0, 0, 0.0])
+      for index in range(len(entry)):
+        entry[index] = entry[index] + counts[index]
+      # End for
+    # End for
+    for index in range(len(self.memo_counts)):
+      self.memo_counts[index] = self.memo_counts[index] + data['memo'][index]
+    # End for
+  # End def merge
+
+  def report(self, out=None):
+    # Print the counts as tables
+    out = sys.stdout if out is None else out
+    print('%-20s %10s %12s %12s'%('Phase', 'Calls', 'Seconds', 'us/call'),
+          file=out)
+    for phase in self.phases:
+      calls, seconds = self.calls.get(phase, (0, 0.0))
+      print('%-20s %10d %12.4f %12.2f'%(phase, calls, seconds,
+                                        seconds * 1.0e6 / max(calls, 1)),
+            file=out)
+    # End for
+    print('%-20s %10s %12.4f'%('Total (wall)', '', _clock() - self.start),
+          file=out)
+    hits, misses = self.memo_counts
+    print('Translation memo: %d hits, %d misses (%.1f%% hits)'%(
+          hits, misses, hits * 100.0 / max(hits + misses, 1)), file=out)
+    print('%-40s %10s %12s %12s'%('Source file', 'Lines', 'Bytes', 'Seconds'),
+          file=out)
+    for src_file in sorted(self.files):
+      lines, nbytes, seconds = self.files[src_file]
+      print('%-40s %10d %12d %12.4f'%(src_file, lines, nbytes, seconds),
+            file=out)
+    # End for
+  # End def report
+
+  def save(self, path):
+    # Write the counts as JSON
+    data = self.data()
+    data['wall'] = _clock() - self.start
+    with open(path, 'w') as pf:
+      json.dump(data, pf, indent=1, sort_keys=True)
+    # End with
+  # End def save
+# End class _Profile
+
+def _profiled(phase, func):
+  # Wrap func to record its calls in _profile (when there is one)
+  def wrapper(*args, **kwargs):
+    if (_profile is None):
+      return func(*args, **kwargs)
+    # End if
+    start = _clock()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      _profile.add(phase, _clock() - start)
+    # End try
+  # End def wrapper
+  return wrapper
+# End def _profiled
+
+def _instrument():
+  # Wrap the functions for each _Profile phase (once, before any pool
+  # is started so workers are instrumented too)
+  global _instrumented, _quickstart, _translate_string
+  if (not _instrumented):
+    _quickstart = _profiled('sphinx-quickstart', _quickstart)
+    _TagScanner.complete_line = _profiled('complete_line',
+                                          _TagScanner.complete_line)
+    _TagScanner.scan = _profiled('read_tags', _TagScanner.scan)
+    _translate_string = _profiled('translate_string', _translate_string)
+    _SubstitutionEngine.substitute = _profiled('substitute',
+                                               _SubstitutionEngine.substitute)
+    _AssetCopier.copy = _profiled('copy images', _AssetCopier.copy)
+    _instrumented = True
+  # End if
+# End def _instrument
+
+def _fl_out(tipe, linenum, filename):
+  sys.stderr.write('%s: line %d of %s'%(tipe, linenum, filename))
+# End def _fl_out
+
+def _warn(s, linenum, filename):
+  _fl_out('WARNING', linenum, filename)
+  sys.stderr.write(": %s\n" % s)
+# End def _warn
+
+class ConversionError(Exception):
+  """A document which cannot be converted, message says why and linenum
+  of filename where."""
+
+  def __init__(self, message, linenum, filename):
+    Exception.__init__(self, message, linenum, filename)
+    self.message = message
+    self.linenum = linenum
+    self.filename = filename
+  # End def __init__
+
+  def __str__(self):
+    return 'ERROR: line %d of %s: %s'%(self.linenum, self.filename,
+                                       self.message)
+  # End def __str__
+# End class ConversionError
+
+def _error(s, linenum, filename):
+  raise ConversionError(s, linenum, filename)
+# End def _error
+
+def _single_tag_warning(tag):
+  return "<%s> should on line by itself, ignoring other tags\n" % tag
+# End def _single_tag_warning
+
+def _warn_single_tag(tag, ntags, linenum, filename):
+  if (ntags > 1):
+    _warn(_single_tag_warning(tag), linenum, filename)
+  # End if
+# End def _warn_single_tag
+
+class _SubstitutionEngine(object):
+  """Apply stringsubs and then aliases to a line in (usually) one scan.
+
+  The result is identical to doing a find and split/join for every
+  stringsubs trigger and then every alias trigger, in dictionary order.
+  Rather than trying every trigger, triggers shaped like <...> or &...;
+  are located by one regular expression scan per delimiter pair and
+  looked up in a table. The line is only rescanned after a replacement
+  whose value could create a trigger which comes later in the order.
+  """
+
+  def __init__(self, aliases=None):
+    if (aliases is None):
+      aliases = {}
+    # End if
+    self.aliases = aliases
+    self.history = list(aliases.items()) # (trigger, value) in add order
+    self.lookups = None # If a set, every candidate trigger looked up
+    self.version = 0 # Equal for engines with the same history
+    for (trigger, value) in self.history:
+      self.version = _alias_version(self.version, trigger, value)
+    # End for
+    self._rebuild()
+  # End def __init__
+
+  def add_alias(self, trigger, value):
+    if (trigger in self.aliases):
+      self._nalias = -1 # A redefinition forces a full rebuild
+    # End if
+    self.aliases[trigger] = value
+    self.history.append((trigger, value))
+    self.version = _alias_version(self.version, trigger, value)
+  # End def add_alias
+
+  def copy(self):
+    # Return an engine with the same aliases (added in the same order) and
+    # a copy of the index
+    if (len(self.aliases) != self._nalias):
+      self._update()
+    # End if
+    engine = _SubstitutionEngine.__new__(_SubstitutionEngine)
+    engine.aliases = {}
+    for (trigger, value) in self.history:
+      engine.aliases[trigger] = value
+    # End for
+    engine.history = list(self.history)
+    engine.version = self.version
+    engine.lookups = None
+    engine._entries = list(self._entries)
+    engine._index = dict([ (_k, list(_v)) for (_k, _v) in self._index.items() ])
+    engine._plain = list(self._plain)
+    engine._rescan = list(self._rescan)
+    engine._quiet = dict([ (_k, list(_v)) for (_k, _v) in self._quiet.items() ])
+    engine._scanners = dict(self._scanners)
+    engine._delims = set(self._delims)
+    engine._plainchars = set(self._plainchars)
+    engine._triggers = self._triggers
+    engine._nsubs = self._nsubs
+    engine._nalias = self._nalias
+    if (list(engine.aliases.keys()) != list(self.aliases.keys())):
+      engine._nalias = -1 # Dictionary order differs, rebuild the index
+    # End if
+    return engine
+  # End def copy
+
+  def _rebuild(self):
+    # Order is the stringsubs order followed by the current alias order
+    self._entries = []
+    self._index = {}
+    self._plain = []
+    self._rescan = []
+    self._quiet = {} # value => entries whose rescan flag is False
+    self._scanners = {}
+    self._delims = set()
+    self._plainchars = set()
+    self._triggers = ''
+    for trigger in stringsubs.keys():
+      self._add_entry(trigger, stringsubs[trigger])
+    # End for
+    self._nsubs = len(self._entries)
+    for trigger in self.aliases.keys():
+      self._add_entry(trigger, self.aliases[trigger])
+    # End for
+    self._nalias = len(self.aliases)
+  # End def _rebuild
+
+  def _update(self):
+    # Index aliases added since the last substitution. Dictionary order
+    # may have changed (Python 2), in which case start over.
+    keys = list(self.aliases.keys())
+    nold = len(self._entries) - self._nsubs
+    if ((self._nalias < 0) or (len(keys) < nold) or
+        (keys[0:nold] != [ _x[0] for _x in self._entries[self._nsubs:] ])):
+      self._rebuild()
+    else:
+      for trigger in keys[nold:]:
+        self._add_entry(trigger, self.aliases[trigger])
+      # End for
+      self._nalias = len(self.aliases)
+    # End if
+  # End def _update
+
+  @staticmethod
+  def _creates_trigger(value, triggers, delims, chars):
+    # Can replacing a trigger by value create an occurrence of a trigger?
+    # An empty value joins its neighbors, otherwise a new occurrence
+    # overlaps value so it shares a delimiter with it or contains it.
+    # (Searching triggers, the longest test, is done last)
+    return ((len(value) == 0) or ('\0' in value) or
+            (len(delims.intersection(value)) > 0) or
+            (len(chars.intersection(value)) > 0) or (value in triggers))
+  # End def _creates_trigger
+
+  def _add_entry(self, trigger, value):
+    num = len(self._entries)
+    self._entries.append((trigger, value))
+    # A trigger c0...c1 with no c0 or c1 inside can be found by a
+    # non-overlapping scan for c0[^c0c1]*c1
+    if ((len(trigger) > 1) and (trigger[0] != trigger[-1]) and
+        (trigger[0] not in trigger[1:-1]) and
+        (trigger[-1] not in trigger[1:-1])):
+      key = (trigger[0], trigger[-1])
+      newdelims = set(key).difference(self._delims)
+      if (key not in self._scanners):
+        self._scanners[key] = re.compile("%s[^%s%s]*%s"%(re.escape(key[0]),
+                                                          re.escape(key[0]),
+                                                          re.escape(key[1]),
+                                                          re.escape(key[1])))
+        self._delims.update(key)
+      # End if
+      self._index.setdefault(trigger, []).append(num)
+      self._triggers = self._triggers + '\0' + trigger
+      newchars = set()
+    else:
+      newdelims = set()
+      newchars = set(trigger)
+      self._plain.append(num)
+      self._plainchars.update(trigger)
+    # End if
+    # Earlier entries may now create this trigger. Usually that can only
+    # happen if their value is a substring of trigger.
+    if ((len(newdelims) > 0) or (len(newchars) > 0)):
+      for prev in range(num):
+        if (not self._rescan[prev]):
+          self._rescan[prev] = self._creates_trigger(self._entries[prev][1],
+                                                     trigger, newdelims,
+                                                     newchars)
+        # End if
+      # End for
+      self._quiet = {}
+      for prev in range(num):
+        if (not self._rescan[prev]):
+          self._quiet.setdefault(self._entries[prev][1], []).append(prev)
+        # End if
+      # End for
+    else:
+      for tb in range(len(trigger)):
+        for te in range(tb + 1, len(trigger) + 1):
+          for prev in self._quiet.pop(trigger[tb:te], ()):
+            self._rescan[prev] = True
+          # End for
+        # End for
+      # End for
+    # End if
+    self._rescan.append(self._creates_trigger(value, self._triggers,
+                                              self._delims, self._plainchars))
+    if (not self._rescan[num]):
+      self._quiet.setdefault(value, []).append(num)
+    # End if
+  # End def _add_entry
+
+  def _find(self, string, after):
+    # Return the set of entries after entry <after> whose trigger is in string
+    found = set()
+    index = self._index
+    lookups = self.lookups
+    for scanner in self._scanners.values():
+      for candidate in scanner.findall(string):
+        if (lookups is not None):
+          lookups.add(candidate)
+        # End if
+        if (candidate in index):
+          found.update(index[candidate])
+        # End if
+      # End for
+    # End for
+    for num in self._plain:
+      if (self._entries[num][0] in string):
+        found.add(num)
+      # End if
+    # End for
+    if (after >= 0):
+      found = set([ _x for _x in found if _x > after ])
+    # End if
+    return found
+  # End def _find
+
+  def depends(self, lookups):
+    """Return the [trigger, value] aliases, in substitution order, which
+    a substitution looking up the triggers in lookups depends on"""
+    if (len(self.aliases) != self._nalias):
+      self._update()
+    # End if
+    plain = set(self._plain)
+    return [ list(self._entries[_x]) for _x in range(self._nsubs,
+                                                     len(self._entries))
+             if ((self._entries[_x][0] in lookups) or (_x in plain)) ]
+  # End def depends
+
+  def substitute(self, string):
+    """Return the substituted string and the stringsubs triggers found"""
+    if (len(self.aliases) != self._nalias):
+      self._update()
+    # End if
+    found = []
+    queued = self._find(string, -1)
+    pending = sorted(queued)
+    pos = 0
+    while (pos < len(pending)):
+      num = pending[pos]
+      pos = pos + 1
+      trigger, value = self._entries[num]
+      if (trigger in string):
+        string = string.replace(trigger, value)
+        if (num < self._nsubs):
+          found.append(trigger)
+        # End if
+        if (self._rescan[num]):
+          new = self._find(string, num).difference(queued)
+          if (len(new) > 0):
+            queued.update(new)
+            pending = sorted(pending[pos:] + list(new))
+            pos = 0
+          # End if
+        # End if
+      # End if
+    # End while
+    return string, found
+  # End def substitute
+# End class _SubstitutionEngine
+
+def _alias_version(version, trigger, value):
+  # Return the version of an alias table (version) after adding an alias.
+  # Tables built by adding the same aliases in the same order (giving the
+  # same substitutions) have the same version.
+  return _alias_versions.setdefault((version, trigger, value),
+                                    len(_alias_versions) + 1)
+# End def _alias_version
+
+def _substitution_engine(aliases):
+  # Return a _SubstitutionEngine for aliases (a dict, an engine or None)
+  global _stringsubs_engine
+  if (isinstance(aliases, _SubstitutionEngine)):
+    return aliases
+  elif (aliases is not None):
+    return _SubstitutionEngine(aliases)
+  elif (_stringsubs_engine is None):
+    _stringsubs_engine = _SubstitutionEngine()
+  # End if
+  return _stringsubs_engine
+# End def _substitution_engine
+
+# Tag handlers by tag name, see _tag_handler
+_tag_handlers = {}
+# Tags whose handlers have side effects (or depend on more than the line
+# and section), lines with them are always translated (see
+# _TranslationMemo)
+_uncached_tags = set()
+
+def _tag_handler(*names):
+  """Decorator registering a handler for the tags names.
+
+  For each tag on a line, in order, _translate_string looks up the
+  handler for its name (if any) and calls
+    handler(tag, str, state, indent, linenum, filename)
+  str is the line so far (after substitutions), state the Converter and
+  indent the indent of the lines which follow. The handler returns the
+  new (str, indent). Apart from setting state.section, a handler should
+  have no side effects and only depend on state.section, or its tag
+  names should be in _uncached_tags (translations are remembered, see
+  _TranslationMemo).
+  """
+  def register(handler):
+    for name in names:
+      _tag_handlers[name] = handler
+    # End for
+    if (_translation_memo is not None):
+      _translation_memo.clear() # Lines may translate differently now
+    # End if
+    return handler
+  # End def register
+  return register
+# End def _tag_handler
+
+def _markup_handler(names, start, end, step=0):
+  """Register handlers replacing the (first remaining) markup of a start
+  tag in names by start and of its end tag by end. A start tag indents
+  the lines which follow by step spaces and its end tag unindents them."""
+  for name in names:
+    for (tag, text, change) in ((name, start, step), ('/' + name, end, -step)):
+      _tag_handler(tag)(_replace_markup(tag, text, change))
+    # End for
+  # End for
+# End def _markup_handler
+
+def _replace_markup(name, text, step):
+  # Return a tag handler for _markup_handler
+  def handler(tag, str, state, indent, linenum, filename):
+    if (step > 0):
+      indent = indent + (' ' * step)
+    elif (step < 0):
+      indent = indent[0:len(indent)+step]
+    # End if
+    return _replace_first(name, str, text), indent
+  # End def handler
+  return handler
+# End def _replace_markup
+
+def _replace_first(name, str, text):
+  # Replace the first markup of tag name (e.g., 'listitem' or '/listitem')
+  # in str by text
+  markupRE = _tag_markupREs.get(name)
+  if (markupRE is None):
+    markupRE = re.compile(r"<%s(?:\s[^<>]*)?/?>"%re.escape(name))
+    _tag_markupREs[name] = markupRE
+  # End if
+  return markupRE.sub(lambda _m: text, str, 1)
+# End def _replace_first
+_tag_markupREs = {}
+
+@_tag_handler(*sectMarkers.keys())
+def _section_tag(tag, str, state, indent, linenum, filename):
+  state.section = tag.name
+  if (tag.words[0:1] != [ 'id' ]):
+    _error('%s tag with missing id'%tag.name, linenum, filename)
+  # End if
+  sectID = tag.words[1]
+  # Lists, figures, ... do not carry over into a section
+  state.lists = []
+  state.caption = None
+  # Assume entire line is section tag and remove it (add blank lines)
+  return "\\n.. _"+_strip_quotes(sectID)+":\\n", ''
+# End def _section_tag
+_uncached_tags.update(sectMarkers.keys()) # (reset the lists and caption)
+
+@_tag_handler('title')
+def _title_tag(tag, str, state, indent, linenum, filename):
+  if ((state.section is None) and (state.caption is not None)):
+    # The title of a figure, example, ... is a rubric (continued on the
+    # lines up to </title>)
+    return '\\n' + _replace_first('title', str.strip(), '.. rubric:: '), \
+      indent + '   '
+  elif (state.section is None):
+    _error('<title>tag with no preceding section tag', linenum, filename)
+  # End if
+  str = ''.join(str.strip().split('<title>'))
+  if (state.section in overbarSect):
+    str = sectMarkers[state.section]+'\n'+str.strip()
+  # End if
+  return str, indent
+# End def _title_tag
+
+@_tag_handler('/title')
+def _end_title_tag(tag, str, state, indent, linenum, filename):
+  if ((state.section is None) and (state.caption is not None)):
+    state.caption = None
+    str = _replace_first('/title', str.strip(), '').strip()
+    return str + '\\n', indent[0:len(indent)-3]
+  elif (state.section is None):
+    _error('</title>tag with no preceding section tag', linenum, filename)
+  # End if
+  str = ''.join(str.strip().split('</title>'))
+  str = str.strip()+'\n'+sectMarkers[state.section]
+  state.section = None
+  return str, indent
+# End def _end_title_tag
+_uncached_tags.update(('title', '/title')) # (depend on state.caption)
+
+# Containers whose (first) title is a rubric, only their content is kept
+_caption_containers = ( 'figure', 'example', 'glossary' )
+
+@_tag_handler(*_caption_containers)
+def _caption_container_tag(tag, str, state, indent, linenum, filename):
+  state.caption = tag.name
+  return _replace_first(tag.name, str, ''), indent
+# End def _caption_container_tag
+
+@_tag_handler(*[ '/' + _x for _x in _caption_containers ])
+def _end_caption_container_tag(tag, str, state, indent, linenum, filename):
+  state.caption = None
+  return _replace_first(tag.name, str, ''), indent
+# End def _end_caption_container_tag
+_uncached_tags.update(_caption_containers)
+_uncached_tags.update([ '/' + _x for _x in _caption_containers ])
+
+@_tag_handler('/note')
+def _end_note_tag(tag, str, state, indent, linenum, filename):
+  str = ''.join(str.strip().split('<'+tag.name+'>'))
+  return str, indent[0:len(indent)-2]
+# End def _end_note_tag
+
+# Keep only the content (_concat)
+_markup_handler(('keyword', 'keywordset', 'abstract', 'bookinfo',
+                 'corpauthor', 'mediaobject', 'imageobject'), '', '')
+# As userinput
+_markup_handler(('computeroutput', 'literal', 'option', 'quote'),
+                stringsubs['<userinput>'], stringsubs['</userinput>'])
+# Emphasis
+_markup_handler(('emphasis', 'productname', 'pubdate'), '*', '*')
+# A block separated with a blank line (as para)
+_markup_handler(('simpara',), '', stringsubs['</para>'])
+
+# Lists are blank-line separated blocks (an escaped newline is not
+# stripped from the end of a line). Each item starts with the marker of
+# its list and its text is indented to line up with the marker. The
+# lists open are in state.lists, as (indent, marker).
+_list_markers = { 'itemizedlist' : '* ', 'orderedlist' : '#. ',
+                  'procedure' : '#. ' }
+
+@_tag_handler(*_list_markers.keys())
+def _list_tag(tag, str, state, indent, linenum, filename):
+  state.lists.append((indent, _list_markers[tag.name]))
+  return _replace_first(tag.name, str, '\\n'), indent
+# End def _list_tag
+
+@_tag_handler(*[ '/' + _x for _x in _list_markers.keys() ])
+def _end_list_tag(tag, str, state, indent, linenum, filename):
+  # Back to the indent of the list (whatever its items left)
+  if (len(state.lists) > 0):
+    indent = state.lists.pop()[0]
+  # End if
+  return _replace_first(tag.name, str, '\\n'), indent
+# End def _end_list_tag
+
+@_tag_handler('listitem', 'step')
+def _list_item_tag(tag, str, state, indent, linenum, filename):
+  # An item starts a line at the indent of its list, not relying on the
+  # end tag of the item before
+  base, marker = (indent, '* ')
+  if (len(state.lists) > 0):
+    base, marker = state.lists[-1]
+  # End if
+  str = _replace_first(tag.name, str, '\\n' + base + marker)
+  return str, base + (' ' * len(marker))
+# End def _list_item_tag
+
+@_tag_handler('/listitem', '/step')
+def _end_list_item_tag(tag, str, state, indent, linenum, filename):
+  return _replace_first(tag.name, str, ''), indent
+# End def _end_list_item_tag
+_uncached_tags.update(_list_markers.keys())
+_uncached_tags.update([ '/' + _x for _x in _list_markers.keys() ])
+_uncached_tags.update(('listitem', 'step')) # (depend on state.lists)
+
+@_tag_handler('screen', 'programlisting')
+def _verbatim_tag(tag, str, state, indent, linenum, filename):
+  # A literal block (a code-block if the language is given), text on the
+  # same line is part of the block. The lines up to the end tag are
+  # copied by the reader (see _DocumentTranslator.verbatim).
+  indent = indent + '   '
+  markup = _verbatimRE.search(str)
+  if (markup is not None):
+    before = str[0:markup.start()].strip()
+    after = str[markup.end():].strip()
+    language = tag.attributes().get('language')
+    if (language is not None):
+      str = before + '\\n\\n' if (len(before) > 0) else ''
+      str = str + '.. code-block:: ' + _strip_quotes(language) + '\\n'
+    else:
+      str = (before + ' ::' if (len(before) > 0) else '::') + '\\n'
+    # End if
+    if (len(after) > 0):
+      str = str + '\\n' + indent + after
+    # End if
+  # End if
+  return str, indent
+# End def _verbatim_tag
+_verbatimRE = re.compile(r"<(?:screen|programlisting)(?:\s[^<>]*)?>")
+
+@_tag_handler('/screen', '/programlisting')
+def _end_verbatim_tag(tag, str, state, indent, linenum, filename):
+  # End of a literal block, text after it starts a new paragraph
+  indent = indent[0:len(indent)-3]
+  markup = _end_verbatimRE.search(str)
+  if (markup is not None):
+    before = str[0:markup.start()].strip()
+    after = str[markup.end():].strip()
+    str = before + '\\n' if (len(before) > 0) else ''
+    if (len(after) > 0):
+      str = str + '\\n' + indent + after
+    # End if
+  # End if
+  return str, indent
+# End def _end_verbatim_tag
+_end_verbatimRE = re.compile(r"</(?:screen|programlisting)\s*>")
+
+@_tag_handler('link', 'xref', 'ulink')
+def _link_tag(tag, str, state, indent, linenum, filename):
+  # A link to an id (:ref: to a section, :doc: to a document) or to a URL,
+  # checked against the book's _XrefIndex if there is one (state.xrefs)
+  markup = _linkREs[tag.name].search(str)
+  if (markup is None):
+    return str, indent
+  # End if
+  text = _link_text(markup.group(1) or '')
+  if (tag.name == 'ulink'):
+    target = _xml_unescape(_strip_quotes(tag.attributes().get('url', '""')))
+    lookup = 'url=' + target
+  else:
+    target = _strip_quotes(tag.attributes().get('linkend', '""'))
+    lookup = 'linkend=' + target
+  # End if
+  resolved = None
+  if (state.xrefs is not None):
+    resolved = state.xrefs.resolve(lookup)
+    if (state.aliases.lookups is not None):
+      state.aliases.lookups.add(lookup) # (see _XrefIndex.depends)
+    # End if
+  elif (tag.name != 'ulink'):
+    resolved = [ 'ref', target, None ] # Leave it to Sphinx
+  # End if
+  if (resolved is not None):
+    if ((len(text) == 0) and (resolved[2] is not None)):
+      text = _link_text(state.aliases.substitute(resolved[2])[0])
+    # End if
+    link = ':%s:`%s`'%(resolved[0], resolved[1])
+    if (len(text) > 0):
+      link = ':%s:`%s <%s>`'%(resolved[0], text, resolved[1])
+    # End if
+  elif (tag.name == 'ulink'):
+    link = '`%s <%s>`__'%(text, target) if (len(text) > 0) else target
+  else:
+    _warn('link to unknown id %s'%target, linenum, filename)
+    link = text if (len(text) > 0) else target
+  # End if
+  return str[0:markup.start()] + link + str[markup.end():], indent
+# End def _link_tag
+@_tag_handler('imagedata', 'graphic')
+def _image_tag(tag, str, state, indent, linenum, filename):
+  # An image, its file is recorded as an 'image=' lookup to be copied
+  # into the ReST sources (see _AssetCopier)
+  markup = _imageREs[tag.name].search(str)
+  fileref = _strip_quotes(tag.attributes().get('fileref', '""'))
+  if ((markup is None) or (len(fileref) == 0)):
+    return str, indent
+  # End if
+  if (fileref.find('://') < 0):
+    if (state.aliases.lookups is not None):
+      state.aliases.lookups.add('image=' + fileref)
+    # End if
+    fileref = _asset_path(fileref, state.source_dir, state.image_root)
+  # End if
+  before = str[0:markup.start()].strip()
+  after = str[markup.end():].strip()
+  str = before + '\\n' if (len(before) > 0) else ''
+  str = str + '\\n' + indent + '.. image:: ' + fileref + '\\n'
+  if (len(after) > 0):
+    str = str + '\\n' + indent + after
+  # End if
+  return str, indent
+# End def _image_tag
+_imageREs = dict([ (_x, re.compile(r"<%s(?:\s[^<>]*?)?(?:/>|>\s*</%s\s*>|>)"%(_x, _x)))
+                   for _x in ('imagedata', 'graphic') ])
+_uncached_tags.update(_imageREs.keys()) # (record their files)
+
+def _link_text(text):
+  # ReST markup does not nest, drop the inline markup delimiters
+  # (stringsubs) and the markup of tags with handlers (which would add
+  # more) from the text of a link
+  text = _handled_markupRE.sub(lambda _m: '' if (_m.group(1) in _tag_handlers)
+                               else _m.group(0), text)
+  return ' '.join(_inline_markupRE.sub('', text).split())
+# End def _link_text
+_handled_markupRE = re.compile(r"<(/?[\w.-]+)(?:\s[^<>]*)?/?>")
+_inline_markupRE = re.compile(r"[`*]+")
+
+_linkREs = dict([ (_x, re.compile(r"<%s(?:\s[^<>]*?)?(?:/>|>(.*?)</%s\s*>)"%(_x, _x),
+                                  re.S)) for _x in ('link', 'xref', 'ulink') ])
+_uncached_tags.update(_linkREs.keys()) # (depend on state.xrefs)
+
+def _translate_string(str, strtags, aliases, state, indent, linenum, filename):
+  indents   = [ '<note>' ] # (the /note tag handler unindents)
+  # Looking for tags and other syntax to translate from docbook to ReST
+  # aliases is a _SubstitutionEngine (or None for stringsubs only)
+  # state is the Converter holding the current section
+
+  str, triggers = _substitution_engine(aliases).substitute(str)
+  for trigger in indents:
+    if (trigger in triggers):
+      indent = indent+'  '
+    # End if
+  # End for
+
+  if (strtags is not None):
+    for tag in strtags:
+      handler = _tag_handlers.get(tag.name)
+      if (handler is not None):
+        str, indent = handler(tag, str, state, indent, linenum, filename)
+      # End if
+    # End for
+  # End if
+
+  return str.strip(), indent
+# End def _translate_string
+
+class _TranslationMemo(object):
+  """Bounded LRU memo of _translate_string results.
+
+  The result for a line depends on the line, its tags, the indent, the
+  section being converted and the aliases. A tag's attributes are part
+  of the line so the key holds the tag names, and the aliases are given
+  by their version (the same for any tables with the same history).
+  The section left by the handlers and the candidate triggers looked
+  up (see _SubstitutionEngine.lookups) are remembered with the result.
+  Lines with a tag in _uncached_tags are always translated, as are lines
+  with no tags or entities (which do not take long).
+  When there are more than size entries, the least recently used quarter
+  is dropped (so the cost of sorting them is spread over many lines).
+  """
+
+  def __init__(self, size):
+    self.size = size
+    self.entries = {} # key -> [result, section, lookups, last use]
+    self.clock = 0
+    self.hits = 0
+    self.misses = 0
+  # End def __init__
+
+  def clear(self):
+    self.entries.clear()
+  # End def clear
+
+  def resize(self, size):
+    self.size = size
+    if (len(self.entries) > size):
+      self._evict()
+    # End if
+  # End def resize
+
+  def _evict(self):
+    # Keep the most recently used three quarters of size entries
+    entries = self.entries
+    keep = self.size - self.size // 4
+    uses = sorted([ (_v[3], _k) for (_k, _v) in list(entries.items()) ])
+    for (use, key) in uses[0:len(uses) - keep]:
+      entries.pop(key, None) # (another thread may have dropped it)
+    # End for
+  # End def _evict
+
+  def translate(self, str, strtags, aliases, state, indent, linenum,
+                filename):
+    # Return _translate_string(...), remembered from a previous call
+    # with the same key if there is one. Lines with no tags or entities
+    # are quicker to translate than to look up.
+    if (strtags):
+      names = tuple([ _x.name for _x in strtags ])
+    elif ('&' in str):
+      names = ()
+    else:
+      names = None
+    # End if
+    if ((names is None) or (not _uncached_tags.isdisjoint(names))):
+      return _translate_string(str, strtags, aliases, state, indent, linenum,
+                               filename)
+    # End if
+    engine = _substitution_engine(aliases)
+    key = (str, names, indent, state.section, engine.version)
+    self.clock = self.clock + 1
+    entry = self.entries.get(key)
+    hit = (entry is not None)
+    if (not hit):
+      self.misses = self.misses + 1
+      lookups = engine.lookups
+      engine.lookups = set()
+      try:
+        result = _translate_string(str, strtags, aliases, state, indent,
+                                   linenum, filename)
+        entry = [ result, state.section, engine.lookups, self.clock ]
+      finally:
+        engine.lookups = lookups
+      # End try
+      self.entries[key] = entry
+      if (len(self.entries) > self.size):
+        self._evict()
+      # End if
+    else:
+      self.hits = self.hits + 1
+      state.section = entry[1]
+      entry[3] = self.clock
+    # End if
+    if (engine.lookups is not None):
+      engine.lookups.update(entry[2])
+    # End if
+    if (_profile is not None):
+      _profile.memo(hit)
+    # End if
+    return entry[0]
+  # End def translate
+# End class _TranslationMemo
+
+def _shared_memo(size):
+  # Return the _TranslationMemo (of up to size entries) shared by
+  # Converters, None if size is 0
+  global _translation_memo
+  if (size <= 0):
+    return None
+  elif (_translation_memo is None):
+    _translation_memo = _TranslationMemo(size)
+  else:
+    _translation_memo.resize(size)
+  # End if
+  return _translation_memo
+# End def _shared_memo
+
+def _set_postline(tags, linenum, filename):
+  postline = None
+  for tag in tags:
+    if (tag in sectMarkers.keys()):
+      _warn_single_tag(tag, len(tags), linenum, filename)
+      postline = sectMarkers[tag]
+      break
+    # End if
+  # End for
+  return postline
+# End def _set_postline
+
+def _rst_filename(filename):
+  # Strip .xml ending if it is there
+  fname = filename.rsplit('.', 1)
+  if (fname[1] == 'xml' or fname[1] == 'XML'):
+    filename = fname[0]
+  # No else because if the ending is not .xml, just leave it alone
+  # End if
+  return filename + '.rst'
+# End def _rst_filename
+
+def _translate_filename(filename, dest_path, remove_old = False):
+  dest_file = os.path.join(dest_path, _rst_filename(filename))
+  if (remove_old and os.path.exists(dest_file)):
+    os.remove(dest_file)
+  # End if
+  try:
+    os.makedirs(os.path.dirname(dest_file), 0755 )
+  except OSError:
+    pass # Probably only get here if directory already exists
+  return dest_file
+# End def _translate_filename
+
+class Converter(object):
+  """Conversion state for a DocBook book and its sub-documents.
+
+  The aliases defined by !ENTITY declarations and the section whose
+  title is being converted carry over from one document to the next, so
+  a book is converted by passing its documents, in order, through the
+  same Converter. Separate Converters are independent.
+  parser selects how documents are read, 'line' (line by line, tolerant of
+  broken markup) or 'xml' (a streaming XML parser, documents must be
+  well-formed).
+  If doctype_cache is a directory, the DOCTYPE declarations read from a
+  file by convert_file are saved there and reused for any file with the
+  same contents.
+  Translated lines are remembered in a memo of up to memo_size entries
+  shared by all Converters (see _TranslationMemo), 0 turns it off.
+  With an _XrefIndex of the book, xrefs, links are checked and resolved
+  to sections or documents (without, a link is assumed to be to a
+  section).
+  Images are named by their path relative to image_root (the book's
+  directory, see _asset_path).
+  """
+
+  def __init__(self, aliases=None, section=None, parser='line',
+               doctype_cache=None, memo_size=4096, xrefs=None,
+               image_root=None):
+    if (aliases is None):
+      aliases = _SubstitutionEngine()
+    # End if
+    self.aliases = _substitution_engine(aliases)
+    self.section = section
+    self.parser = parser
+    self.doctype_cache = doctype_cache
+    self.memo_size = memo_size
+    self.memo = _shared_memo(memo_size)
+    self.xrefs = xrefs
+    self.image_root = image_root
+    self.source_dir = None # Directory of the document being converted
+    self.subdocs = [] # Declared by the last document converted
+    self.lists = [] # The lists open (see _list_tag)
+    self.caption = None # A figure, ... whose title is still to come
+    self._doctype = None # (key, cached DOCTYPE) of the file being converted
+  # End def __init__
+
+  def options(self):
+    # Keyword arguments for a Converter like this one
+    return { 'parser' : self.parser, 'doctype_cache' : self.doctype_cache,
+             'memo_size' : self.memo_size, 'xrefs' : self.xrefs,
+             'image_root' : self.image_root }
+  # End def options
+
+  def convert_stream(self, lines, filename='<stream>', master=False,
+                     dest_path=None):
+    """Generate the ReST text for the DocBook text in lines.
+
+    lines may be any iterable of lines (e.g., an open file), it is read
+    one line at a time. Each item generated is one or more lines of ReST
+    ending with a newline. filename is used in messages. If master is
+    True, a toctree preamble is generated for the book. When dest_path
+    is given, the outputs of sub-documents included by the book are
+    expected there and old versions are removed.
+    The sub-documents declared by the stream are in self.subdocs once
+    it is exhausted.
+    """
+    self.subdocs = []
+    return _readers[self.parser](lines, self, filename, dest_path, master)
+  # End def convert_stream
+
+  def convert_file(self, path, out, master=False):
+    """Convert the DocBook file, path, to ReST.
+
+    out is either an open file or the name of the file to create (the
+    directory of which is dest_path for convert_stream).
+    Return the sub-documents declared by path as a list of
+    (name, path, linenum, filename) tuples.
+    """
+    filename = os.path.basename(path)
+    self.source_dir = os.path.dirname(os.path.abspath(path))
+    if (self.doctype_cache is not None):
+      self._doctype = _cached_doctype(path, self.doctype_cache)
+    # End if
+    try:
+      with _open_source(path) as sf:
+        lines = sf
+        if (_profile is not None):
+          lines = _profile.count(path, sf)
+        # End if
+        if (hasattr(out, 'write')):
+          _write_text(out, self.convert_stream(lines, filename, master))
+        elif (_pipeline is not None):
+          _pipeline.write(out, list(self.convert_stream(lines, filename,
+                                                        master,
+                                                        os.path.dirname(out))))
+        else:
+          with open(out, "w+", _io_buffer) as df:
+            _write_text(df, self.convert_stream(lines, filename, master,
+                                                os.path.dirname(out)))
+          # End with
+        # End if
+      # End with
+    finally:
+      self._doctype = None
+    # End try
+    return self.subdocs
+  # End def convert_file
+# End class Converter
+
+def convert_stream(lines, filename='<stream>', master=False, aliases=None,
+                   parser='line'):
+  """Generate the ReST text for the DocBook text in lines with a new
+  Converter (see Converter.convert_stream)"""
+  return Converter(aliases, parser=parser).convert_stream(lines, filename,
+                                                          master)
+# End def convert_stream
+
+def convert_file(path, out, master=False, aliases=None, parser='line'):
+  """Convert the DocBook file, path, to ReST in out with a new Converter
+  (see Converter.convert_file)"""
+  return Converter(aliases, parser=parser).convert_file(path, out, master)
+# End def convert_file
+
+def _write_text(out, texts):
+  write = out.write
+  if (_profile is not None):
+    write = _profiled('write', write)
+  # End if
+  for text in texts:
+    write(text)
+  # End for
+# End def _write_text
+
+def _translate_docbook_source(src_file, dest_path, converter, master=False):
+  # Convert src_file into dest_path, return the sub-documents it declares
+  dest_file = _translate_filename(os.path.basename(src_file), dest_path, True)
+  return converter.convert_file(src_file, dest_file, master)
+# End def _translate_docbook_source
+
+def _translate_lines(lines, converter, filename, dest_path, master,
+                     shard=None):
+  # Generator doing the work of Converter.convert_stream. For a shard of
+  # a document (see _shard_task), lines start at line shard['first'] in
+  # the state given by shard (see _shard_state) and the state they leave
+  # is put in shard['end'].
+  doc = _DocumentTranslator(converter, filename, dest_path, master)
+  inDOCTYPE = False
+  linenum = 0
+  linein = ''
+  scanner = _TagScanner() # Holds linein while it is incomplete
+  cached = converter._doctype # (key, DOCTYPE declarations or None) or None
+  first = 1       # linein starts on this line
+  skip = 0        # Skip the lines up to here (a cached DOCTYPE section)
+  declared = None # The DOCTYPE section being cached
+  verbatim = None # The open literal block (see _verbatim_end)
+  if (shard is not None):
+    linenum = shard['first'] - 1
+    inDOCTYPE = shard['inDOCTYPE']
+    verbatim = shard['verbatim']
+    doc.inBook = shard['inBook']
+    doc.indent = shard['indent']
+    doc.subdoc_paths = dict(shard['subdoc_paths'])
+    converter.lists = [ tuple(_x) for _x in shard['lists'] ]
+    converter.caption = shard['caption']
+  # End if
+  for line in lines:
+    linenum = linenum + 1
+    if (linenum <= skip):
+      continue
+    elif (verbatim is not None):
+      # Copy literal block lines through until the end tag
+      end = _verbatim_ends[verbatim].search(line)
+      if (end is None):
+        yield doc.verbatim(line)
+        continue
+      # End if
+      if (len(line[0:end.start()].strip()) > 0):
+        yield doc.verbatim(line[0:end.start()])
+      # End if
+      line = line[end.start():]
+      verbatim = None
+    # End if
+    if (len(linein) == 0):
+      scanner.clear()
+      first = linenum
+      if ((cached is not None) and (cached[1] is not None) and
+          (cached[1]['start'] == linenum)):
+        # Replay the declarations instead of reading the DOCTYPE again
+        for (declnum, events) in cached[1]['events']:
+          doc.declare(events, declnum)
+        # End for
+        skip = cached[1]['end']
+        continue
+      # End if
+    # End if
+    scanner.append(line)
+    linein, ltags = scanner.complete_line(linenum, filename)
+    if ((ltags is not None) or 
+        (doctypeRE.match(linein.strip()) is not None) or
+        (linein.strip().find(']>') > -1)):
+      if (ltags is None):
+        ltags = []
+      # End if
+      mask = _tag_mask(ltags)
+      if (doctypeRE.search(linein) is not None):
+        if (inDOCTYPE):
+          _error('Nested DOCTYPE tags', linenum, filename)
+        else:
+          inDOCTYPE = True
+          linein = '' # Ignore this line
+          if ((cached is not None) and (cached[1] is None) and
+              (len(scanner._warnings) == 0)):
+            declared = { 'start' : first, 'events' : [] }
+          # End if
+        # End if
+      elif (inDOCTYPE):
+        # Here, we only process !ENTITY tags
+        events = []
+        if (mask & _T_ENTITY):
+          if (len(ltags) > 1):
+            events.append(('warn', _single_tag_warning('!ENTITY')))
+          # End if
+          events.extend(_entity_events([ _x for _x in ltags if _x.code == _T_ENTITY ][0], linenum, filename))
+        elif ((len(ltags) == 0) and (linein.find(']>') >= 0)):
+          inDOCTYPE = False
+          if (declared is not None):
+            declared['end'] = linenum
+            _save_doctype(cached[0], declared, converter.doctype_cache)
+            declared = None
+          # End if
+        else:
+          if (len(linein.strip()) > 0):
+            events.append(('warn', 'Unnkown line in DOCTYPE section'))
+          # End if
+        # End if
+        doc.declare(events, linenum)
+        if ((declared is not None) and (len(events) > 0)):
+          if (len(scanner._warnings) > 0):
+            declared = None # The scanner warnings would not be replayed
+          else:
+            declared['events'].append([ linenum, events ])
+          # End if
+        # End if
+        linein = '' # Always pretend we successfully handled this line (hack?)
+      else:
+        text = doc.translate(linein, ltags, mask, linenum)
+        linein = ''
+        if (text is not None):
+          yield text
+        # End if
+        if (mask & _T_VERBATIM):
+          verbatim = _verbatim_end(ltags)
+        # End if
+      # End if (line match)
+    else: # just add in next line
+      pass
+    # End if (not incomplete line)
+  # End for
+  if (shard is not None):
+    shard['end'] = _shard_state(doc, inDOCTYPE, verbatim, len(linein) > 0)
+  # End if
+# End def _translate_lines
+
+def _shard_state(doc=None, inDOCTYPE=False, verbatim=None, pending=False):
+  # The state of _translate_lines which carries over from one line to the
+  # next, apart from the Converter's aliases and section (but with its
+  # open lists and caption). pending is True in the middle of a logical
+  # line. With no doc, the state at the start of a document.
+  state = { 'inDOCTYPE' : inDOCTYPE, 'verbatim' : verbatim,
+            'inBook' : False, 'indent' : '', 'subdoc_paths' : {},
+            'lists' : [], 'caption' : None, 'pending' : pending }
+  if (doc is not None):
+    state.update(inBook=doc.inBook, indent=doc.indent,
+                 subdoc_paths=dict(doc.subdoc_paths),
+                 lists=[ tuple(_x) for _x in doc.converter.lists ],
+                 caption=doc.converter.caption)
+  # End if
+  return state
+# End def _shard_state
+
+def _verbatim_end(tags):
+  # Return the name of a literal block element left open by tags (None if
+  # there is none)
+  for tag in reversed(tags):
+    if (tag.code == _T_VERBATIM):
+      if (tag.words[-1:] == [ '/' ]):
+        return None
+      # End if
+      return tag.name
+    elif (tag.code == _T_END_VERBATIM):
+      return None
+    # End if
+  # End for
+  return None
+# End def _verbatim_end
+_verbatim_ends = dict([ (_x, re.compile(r"</%s\s*>"%_x)) # (end tags)
+                        for _x in ('screen', 'programlisting') ])
+_markupRE = re.compile(r"<[^<>]*>")
+
+def _entity_events(entag, linenum, filename):
+  """Return the events for an !ENTITY declaration: ('warn', message),
+  ('subdoc', name, path) or ('alias', key, value). They only depend on
+  the tag so the declarations of a DOCTYPE section can be cached."""
+  words = entag.words
+  if (len(words) < 1):
+    return [ ('warn', 'Malformed !ENTITY tag') ]
+  elif ((len(words) > 2) and (words[1] == 'SYSTEM')):
+    # We have a new subdoc but it may be a partial path
+    return [ ('subdoc', words[0], _strip_quotes(words[2])) ]
+  elif (len(words) > 1):
+    # Treat this as an alias (only stringsubs apply to its value)
+    value = _translate_string(words[1], None, None, None, '', linenum, filename)[0]
+    return [ ('alias', "&" + words[0] + ";", _strip_quotes(value)) ]
+  # End if
+  return []
+# End def _entity_events
+
+class _DocumentTranslator(object):
+  """Translation state for one document (sub-documents declared so far,
+  inside the book or not and the current indent).
+
+  The readers (_translate_lines and _translate_xml) find the logical lines
+  and !ENTITY declarations of a document and pass them on in order.
+  """
+
+  def __init__(self, converter, filename, dest_path, master):
+    self.converter = converter
+    self.filename = filename
+    self.dest_path = dest_path
+    self.master = master
+    self.subdocs = converter.subdocs # Cannot use dictionary because order matters
+    self.subdoc_paths = {} # Path of each sub-document (first declaration)
+    self.inBook = False
+    self.indent = ''
+    self.newindent = ''
+  # End def __init__
+
+  def entity(self, entag, linenum):
+    # Record an !ENTITY declaration (a sub-document or an alias)
+    self.declare(_entity_events(entag, linenum, self.filename), linenum)
+  # End def entity
+
+  def declare(self, events, linenum):
+    # Apply the events (see _entity_events) of a DOCTYPE line
+    for event in events:
+      if (event[0] == 'warn'):
+        _warn(event[1], linenum, self.filename)
+      elif (event[0] == 'subdoc'):
+        self.subdocs.append((event[1], event[2], linenum, self.filename))
+        self.subdoc_paths.setdefault(event[1], event[2])
+      else:
+        self.converter.aliases.add_alias(event[1], event[2])
+      # End if
+    # End for
+  # End def declare
+
+  def translate(self, linein, ltags, mask, linenum):
+    # Return the ReST text for a logical line (or None), mask is the
+    # codes of ltags or'ed together (see _tag_mask)
+    filename = self.filename
+    text = ''
+    lineout = None
+    if (mask & _T_BOOK):
+      if (self.inBook):
+        _error('Nested book tags', linenum, filename)
+      else:
+        _warn_single_tag('book', len(ltags), linenum, filename)
+        self.inBook = True
+        if (self.master) :
+          text = preamble + '\n'
+        # End if
+        lineout = ''
+      # End if
+    elif (mask & _T_END_BOOK):
+      if (not self.inBook):
+        _error('End book tag found before opening tag', linenum, filename)
+      else:
+        _warn_single_tag('/book', len(ltags), linenum, filename)
+        self.inBook = False
+      # End if
+    elif (self.inBook):
+      cmatch = codeItemRE.search(linein)
+      if (cmatch is not None):
+        # Insert doc here
+        filesym = cmatch.group(1)
+        # Find the filename for filesym
+        fmatch = self.subdoc_paths.get(filesym)
+        if (fmatch is not None):
+          if (self.dest_path is None):
+            sub_file = _rst_filename(fmatch)
+          else:
+            sub_file = _translate_filename(fmatch, self.dest_path, True)
+          # End if
+          sub_file = os.path.basename(sub_file)
+          lineout = '   ' + sub_file
+        # End if
+      else:
+        lineout, self.newindent = self._translate_string(linein, ltags, linenum)
+      # End if
+    else:
+      lineout, self.newindent = self._translate_string(linein, ltags, linenum)
+    # End if (line match)
+    if (lineout is None):
+      return None
+    # End if
+    text = text + self.indent + lineout.replace('\\n', '\n') + '\n'
+    self.indent = self.newindent
+    return text
+  # End def translate
+
+  def _translate_string(self, linein, ltags, linenum):
+    # _translate_string, through the memo if there is one
+    converter = self.converter
+    if (converter.memo is None):
+      return _translate_string(linein, ltags, converter.aliases, converter,
+                               self.indent, linenum, self.filename)
+    # End if
+    return converter.memo.translate(linein, ltags, converter.aliases,
+                                    converter, self.indent, linenum,
+                                    self.filename)
+  # End def _translate_string
+
+  def verbatim(self, line):
+    # Return the ReST text for a source line inside a literal block. It is
+    # copied as is (no tag scanning or translation), only markup is
+    # dropped and entities (&lt;, &amp;, aliases, ...) are substituted.
+    line = _markupRE.sub('', line).rstrip()
+    if (len(line.strip()) == 0):
+      return '\n'
+    # End if
+    line = _substitution_engine(self.converter.aliases).substitute(line)[0]
+    line = line.replace('&quot;', '"').replace('&apos;', "'")
+    return self.indent + line.replace('&amp;', '&') + '\n'
+  # End def verbatim
+# End class _DocumentTranslator
+
+def _translate_xml(lines, converter, filename, dest_path, master):
+  # Generator doing the work of Converter.convert_stream with the XML
+  # parser (--parser=xml)
+  doc = _DocumentTranslator(converter, filename, dest_path, master)
+  for (linenum, linein, ltags) in _XMLReader(filename).read(lines):
+    if (linein is None):
+      doc.entity(ltags, linenum)
+    elif (ltags is None):
+      yield doc.verbatim(linein)
+    else:
+      text = doc.translate(linein, ltags, _tag_mask(ltags), linenum)
+      if (text is not None):
+        yield text
+      # End if
+    # End if
+  # End for
+# End def _translate_xml
+
+def _xml_escape(text, quote=False):
+  # Write text (or an attribute value if quote) back as XML
+  text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+  if (quote):
+    text = text.replace('"', '&quot;')
+  # End if
+  return text
+# End def _xml_escape
+
+def _xml_unescape(text):
+  # Undo _xml_escape (e.g., for a URL from an attribute)
+  text = text.replace('&lt;', '<').replace('&gt;', '>')
+  return text.replace('&quot;', '"').replace('&amp;', '&')
+# End def _xml_unescape
+
+class _XMLReader(object):
+  """Streaming expat reader for the logical lines of a DocBook document.
+
+  A logical line is the text of a source line (or of several lines while
+  a link, ulink or bookinfo element is open, as for _TagScanner) with its
+  markup written back as XML, and its tags in the form _TagScanner gives
+  them. The DOCTYPE is not returned but each !ENTITY declaration in it
+  is, as an entity tag in place of the tags with None for the line.
+  Entity references are not expanded so aliases and sub-documents are
+  handled just as for the line-based reader. Ignored tags are dropped
+  along with comments and processing instructions. The source lines of a
+  screen or programlisting element, after the line of its start tag and
+  up to its end tag, are returned as they are with None for the tags.
+  """
+
+  def __init__(self, filename):
+    parser = xml.parsers.expat.ParserCreate()
+    if (hasattr(parser, 'returns_unicode')):
+      parser.returns_unicode = False # Python 2, keep (UTF-8) str
+    # End if
+    # Sub-documents have no DOCTYPE, this lets them use undeclared aliases
+    parser.UseForeignDTD(True)
+    parser.SetParamEntityParsing(
+      xml.parsers.expat.XML_PARAM_ENTITY_PARSING_UNLESS_STANDALONE)
+    parser.ordered_attributes = True
+    parser.StartElementHandler = self._start
+    parser.EndElementHandler = self._end
+    parser.CharacterDataHandler = self._data
+    # Without DefaultHandlerExpand, entity references arrive here as is
+    parser.DefaultHandler = self._default
+    parser.EntityDeclHandler = self._entity
+    parser.StartDoctypeDeclHandler = self._start_doctype
+    parser.EndDoctypeDeclHandler = self._end_doctype
+    parser.XmlDeclHandler = self._markup
+    parser.CommentHandler = self._markup
+    parser.ProcessingInstructionHandler = self._markup
+    self.parser = parser
+    self.filename = filename
+    self.lines = []         # Completed lines not yet returned
+    self.parts = []         # Text of the current line
+    self.tags = []          # Tags of the current line
+    self.markup = False     # Current line has markup (maybe ignored)
+    self.atomic = 0         # Number of open atomic elements
+    self.inDOCTYPE = False
+    self.skip = False       # Drop the current line (ends the DOCTYPE)
+    self._empty = None      # Index in parts of a start tag just seen
+    self.verbatim = None    # Name of the open literal block element
+    self.inverbatim = False # Current line is in the literal block
+  # End def __init__
+
+  def read(self, lines):
+    # Generate (linenum, line, tags) for each logical line in lines
+    for text in itertools.chain(lines, (None,)):
+      try:
+        if (text is None):
+          self.parser.Parse('', True)
+          self._flush(self.parser.CurrentLineNumber)
+        else:
+          self.parser.Parse(text, False)
+        # End if
+      except xml.parsers.expat.ExpatError as e:
+        _error('XML %s at column %d'%(xml.parsers.expat.ErrorString(e.code),
+                                      e.offset), e.lineno, self.filename)
+      # End try
+      for line in self.lines:
+        yield line
+      # End for
+      self.lines = []
+    # End for
+  # End def read
+
+  def _flush(self, linenum):
+    # End the current line (if anything is on it)
+    if (self.inverbatim):
+      self.lines.append((linenum, ''.join(self.parts), None))
+      self.parts = []
+      self.tags = []
+      self.markup = False
+    elif (self.atomic > 0):
+      self.parts.append('\n')
+    else:
+      text = ''.join(self.parts)
+      line = ' '.join([ _x.strip() for _x in text.split('\n')
+                        if len(_x.strip()) > 0 ])
+      if (self.skip):
+        self.skip = False
+      elif (self.markup or (len(line) > 0)):
+        self.lines.append((linenum, line, self.tags))
+      # End if
+      self.parts = []
+      self.tags = []
+      self.markup = False
+    # End if
+    self._empty = None
+    self.inverbatim = (self.verbatim is not None)
+  # End def _flush
+
+  def _text(self, text):
+    # Add text (which may span lines) to the current line
+    lines = text.split('\n')
+    linenum = self.parser.CurrentLineNumber
+    if (len(lines[0]) > 0):
+      self.parts.append(lines[0])
+      self._empty = None
+    # End if
+    for line in lines[1:]:
+      self._flush(linenum)
+      linenum = linenum + 1
+      if (len(line) > 0):
+        self.parts.append(line)
+      # End if
+    # End for
+  # End def _text
+
+  def _start(self, name, attrs):
+    self.markup = True
+    if (_tag_codes.get(name) == _T_IGNORE):
+      return
+    # End if
+    words = []
+    text = '<' + name
+    for index in range(0, len(attrs), 2):
+      value = '"%s"'%_xml_escape(attrs[index + 1], True)
+      words.extend((attrs[index], value))
+      text = text + ' ' + attrs[index] + '=' + value
+    # End for
+    self.parts.append(text + '>')
+    self.tags.append(_Tag(name, words))
+    self._empty = len(self.parts) - 1
+    if (name in _TagScanner._atomic):
+      self.atomic = self.atomic + 1
+    elif ((self.verbatim is None) and
+          (_tag_codes.get(name) == _T_VERBATIM)):
+      self.verbatim = name
+    # End if
+  # End def _start
+
+  def _end(self, name):
+    self.markup = True
+    if (name in _TagScanner._atomic):
+      self.atomic = self.atomic - 1
+    elif (name == self.verbatim):
+      if (self.inverbatim):
+        # The end tag starts a line, as for the line-based reader
+        if (len(''.join(self.parts).strip()) > 0):
+          self._flush(self.parser.CurrentLineNumber)
+        # End if
+        self.parts = []
+        self.tags = []
+        self.markup = True
+      # End if
+      self.verbatim = None
+      self.inverbatim = False
+    # End if
+    if (_tag_codes.get('/' + name) == _T_IGNORE):
+      pass
+    elif (self._empty == len(self.parts) - 1):
+      # <name/>
+      self.parts[-1] = self.parts[-1][:-1] + '/>'
+      self.tags[-1].words.append('/')
+    else:
+      self.parts.append('</' + name + '>')
+      self.tags.append(_Tag('/' + name, []))
+    # End if
+    self._empty = None
+  # End def _end
+
+  def _data(self, data):
+    self._text(_xml_escape(data))
+  # End def _data
+
+  def _default(self, data):
+    if (self.inDOCTYPE):
+      pass
+    elif ((data[0:1] == '&') and (data[-1:] == ';')):
+      self.parts.append(data) # Entity reference
+      self._empty = None
+    elif (len(data.strip()) == 0):
+      self._text(data) # White space outside the root element
+    # End if
+  # End def _default
+
+  def _markup(self, *args):
+    self.markup = True
+  # End def _markup
+
+  def _entity(self, name, is_parameter_entity, value, base, systemId,
+              publicId, notationName):
+    if (is_parameter_entity):
+      return
+    elif (value is not None):
+      entag = _Tag('!ENTITY', [ name, '"%s"'%value ])
+    else:
+      entag = _Tag('!ENTITY', [ name, 'SYSTEM', '"%s"'%systemId ])
+    # End if
+    self.lines.append((self.parser.CurrentLineNumber, None, entag))
+  # End def _entity
+
+  def _start_doctype(self, name, systemId, publicId, has_internal_subset):
+    self.inDOCTYPE = True
+  # End def _start_doctype
+
+  def _end_doctype(self):
+    self.inDOCTYPE = False
+    self.skip = True # The rest of the line, as for the line-based reader
+  # End def _end_doctype
+# End class _XMLReader
+
+# Document readers for Converter (by parser name)
+_readers = { 'line' : _translate_lines, 'xml' : _translate_xml }
+
+def _strip_quotes(string):
+  # Make sure this is a quoted string
+  strb = 0
+  stre = len(string) - 1
+  if (((string[strb] == '"') and (string[stre] == '"')) or
+      ((string[strb] == "'") and (string[stre] == "'"))):
+    return string[strb+1:stre]
+  else:
+    return string
+  # End if
+# End def _strip_quotes
+
+class _Tag(object):
+  """A tag on a line: its name, the words following the name (attribute
+  names and quoted values or, e.g., the parts of an !ENTITY declaration)
+  and its span, the (start, end) of the tag in the line (None if not
+  known). code is the _tag_codes entry for the name (_T_OTHER if none).
+  Names are interned as the same few names are found on every line.
+  """
+
+  __slots__ = ('name', 'code', 'words', 'span')
+
+  def __init__(self, name, words, span=None):
+    self.name = _intern(name)
+    self.code = _tag_codes.get(name, _T_OTHER)
+    self.words = words
+    self.span = span
+  # End def __init__
+
+  def attributes(self):
+    # Return the attributes ({ name : quoted value }) of the tag
+    words = self.words
+    return dict([ (words[_x - 1], words[_x]) for _x in range(1, len(words))
+                  if (words[_x][0:1] in ('"', "'")) ])
+  # End def attributes
+
+  def __repr__(self):
+    return '<%s>'%' '.join([ self.name ] + self.words)
+  # End def __repr__
+# End class _Tag
+
+def _tag_mask(tags):
+  # Return the codes of tags or'ed together (the kinds of tags present)
+  mask = _T_OTHER
+  for tag in tags:
+    mask = mask | tag.code
+  # End for
+  return mask
+# End def _tag_mask
+
+class _TagScanner(object):
+  """Single pass tokenizer for the tags on a logical line.
+
+  Quoted strings, tag boundaries and the nesting level are found in one
+  walk over the tokens matched by tagtokenRE (the regular expression
+  engine skips the text in between).
+  A logical line may be continued over several physical lines (append).
+  The scanner keeps its state (open quote, nesting level, partial tag and
+  the open link, ulink or bookinfo tags) so that each physical line is
+  only scanned once.
+  """
+
+  # Tags which we need to process atomically
+  _atomic = ('link', 'ulink', 'bookinfo')
+
+  def __init__(self, line='', level=0):
+    self.line = line
+    self.level = level
+    self.tags = []
+    self._pos = 0      # Tokens have been scanned up to here
+    self._qend = 0     # Every string is closed up to here
+    self._inds = None  # Start of the current tag (just past the <)
+    self._spans = []   # Strings found in the current tag
+    self._nchecked = 0 # Number of tags checked for atomic open and close
+    self._matches = dict([ (_x, True) for _x in self._atomic ])
+    self._warnings = []
+  # End def __init__
+
+  def clear(self):
+    self.__init__()
+  # End def clear
+
+  def append(self, text):
+    # Continue the logical line with text (a physical line)
+    text = text.strip()
+    if (len(text) > 0):
+      if (len(self.line) > 0):
+        self.line = self.line + " " + text
+      else:
+        self.line = text
+      # End if
+    # End if
+  # End def append
+
+  def complete_line(self, linenum, filename):
+    """Return the line and its tags or the line and None if it is
+    incomplete (unclosed string or tag or open atomic tag)"""
+    tags = None
+    line = self.line
+    if (len(line) > 0):
+      # Nothing to do until every string on the line is closed
+      self._qend = quotedRE.match(line, self._qend).end()
+      if (self._qend == len(line)):
+        self._qend = self.scan(self._qend, linenum, filename)
+        line = self.line
+        if ((self.level == 0) and (not self._incomplete(linenum, filename))):
+          tags = self.tags
+        # End if
+      # End if
+    # End if
+    return line, tags
+  # End def complete_line
+
+  def scan(self, qend, linenum, filename):
+    # Scan the new part of line, strings are only quoted up to qend. An
+    # ignored tag is removed from line, return qend moved to match.
+    moved = qend
+    while (moved is not None):
+      qend = moved
+      moved = self._scan(qend, linenum, filename)
+    # End while
+    self._pos = len(self.line)
+    return qend
+  # End def scan
+
+  def _scan(self, qend, linenum, filename):
+    # Scan line from _pos to its end (return None) or to an ignored tag,
+    # which is removed from line (return qend moved to match)
+    line = self.line
+    for token in itertools.chain(tagtokenRE.finditer(line, self._pos, qend),
+                                 angleRE.finditer(line, max(qend, self._pos))):
+      tok = token.group()
+      if (tok == '<'):
+        if (self.level == 0):
+          self._inds = token.start() + 1
+          self._spans = []
+        # End if
+        self.level = self.level + 1
+      elif (tok == '>'):
+        self.level = self.level - 1
+        if (self.level == 0):
+          inds = self._inds
+          inde = token.start()
+          if ((inds is None) or (inds >= inde)):
+            _error('Internal Error?', linenum, filename)
+          # End if
+          newtag = self._new_tag(inde)
+          self._inds = None
+          if (_tag_codes.get(newtag[0]) == _T_IGNORE):
+            # We need to pretend this whole tag isn't there
+            self.line = line[0:inds-1] + line[inde+1:]
+            if (qend > inde):
+              qend = qend - (inde + 2 - inds)
+            else:
+              qend = min(qend, inds - 1)
+            # End if
+            self._pos = inds - 1
+            return qend
+          else:
+            # Remove empty newtag elements, then append
+            newtag = [ _x for _x in newtag if len(_x) > 0]
+            self.tags.append(_Tag(newtag[0] if len(newtag) > 0 else '',
+                                  newtag[1:], (inds - 1, inde + 1)))
+          # End if
+        # No else, this is an embedded tag close
+        # End if
+      elif (self._inds is not None):
+        self._spans.append((token.start(), token.end()))
+      # End if (strings outside of a tag are just skipped)
+    # End for
+    return None
+  # End def _scan
+
+  def _new_tag(self, inde):
+    # Split the current tag into words, note, there could be spaces
+    # inside a string. The character before each string (e.g., =) is dropped.
+    line = self.line
+    newtag = list()
+    tagb = self._inds
+    for (strb, stre) in self._spans:
+      if (tagb < strb):
+        newtag.extend(line[tagb:strb-1].strip().split(" "))
+      # End if
+      newtag.append(line[strb:stre])
+      tagb = stre
+    # End for
+    if (inde > tagb):
+      newtag.extend(line[tagb:inde].strip().split(" "))
+    # End if
+    return newtag
+  # End def _new_tag
+
+  def _incomplete(self, linenum, filename):
+    # Is an atomic tag still open? Only new tags need checking but all
+    # warnings are repeated, just as if the whole line was checked again.
+    for warning in self._warnings:
+      _warn(warning, linenum, filename)
+    # End for
+    for tag in self.tags[self._nchecked:]:
+      warning = None
+      if (tag.code == _T_ATOMIC):
+        if (self._matches[tag.name]):
+          self._matches[tag.name] = False
+        else:
+          warning = 'open tag after close tag for %s?'%tag.name
+        # End if
+      elif (tag.code == _T_END_ATOMIC):
+        if (self._matches[tag.name[1:]]):
+          warning = 'close tag before open tag for %s?'%tag.name
+        else:
+          self._matches[tag.name[1:]] = True
+        # End if
+      # End if
+      if (warning is not None):
+        self._warnings.append(warning)
+        _warn(warning, linenum, filename)
+      # End if
+    # End for
+    self._nchecked = len(self.tags)
+    return (False in self._matches.values())
+  # End def _incomplete
+# End class _TagScanner
+
+def _read_tags(line, linenum, filename):
+  qend = quotedRE.match(line).end()
+  scanner = _TagScanner(line, -1 if (qend < len(line)) else 0)
+  scanner.scan(qend, linenum, filename)
+  return scanner.line, scanner.tags, (scanner.level != 0)
+# End def _read_tags
+
+def _complete_line(line, linenum, filename):
+  scanner = _TagScanner()
+  scanner.append(line)
+  return scanner.complete_line(linenum, filename)
+# End def _complete_line
 
 if __name__ == '__main__':
    _main()
@@ -0,0 +1,749 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks for the DocBook to ReST converter
+    =========================
+    Timing harness for db2rst.py, run from the directory containing
+    db2rst.py, e.g., python db2rst_bench.py scanner
+    The book benchmark converts a synthetic CESM style book, e.g.,
+      python db2rst_bench.py book --chapters 20 --save-baseline base.json
+      (change db2rst.py)
+      python db2rst_bench.py book --chapters 20 --baseline base.json
+    python db2rst_bench.py generate DIR writes the same book to DIR.
+    python db2rst_bench.py diff compares the output of the line-based and
+    XML parsers for a synthetic (or --source) book.
+    python db2rst_bench.py slowfs times a synthetic book on a simulated
+    slow file system with each --prefetch depth.
+    python db2rst_bench.py dispatch times tag translation per line as more
+    tag handlers are registered.
+    python db2rst_bench.py assets times copying images into a destination
+    (--destination on another file system to time copies, not links).
+
+"""
+
+# Python 3 compatible printing in Python 2.
+from __future__ import print_function
+import argparse
+import timeit
+import time
+import random
+import os
+import os.path
+import sys
+import shutil
+import tempfile
+import json
+import difflib
+import filecmp
+try:
+  import resource
+except ImportError:
+  resource = None # No peak memory on this platform
+# End try
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
+# End try
+
+import db2rst
+
+def _main():
+  parser = argparse.ArgumentParser(description='Benchmark db2rst.py')
+  subparsers = parser.add_subparsers(dest='bench')
+  scanner = subparsers.add_parser('scanner',
+                                  help='tag scanner micro-benchmark')
+  scanner.add_argument('--attributes', default='1,10,100,1000',
+                       help='comma separated numbers of attributes per line')
+  scanner.add_argument('--repeat', type=int, default=5,
+                       help='number of timing repeats (best is reported)')
+  book = subparsers.add_parser('book',
+                               help='convert a synthetic CESM style book')
+  _add_book_arguments(book)
+  book.add_argument('--repeat', type=int, default=3,
+                    help='number of timed conversions (best is reported)')
+  book.add_argument('--parser', choices=('line', 'xml'), default='line',
+                    help='db2rst.py parser to benchmark')
+  book.add_argument('--memo-size', type=int, default=4096,
+                    help='db2rst.py --memo-size (0 turns the memo off)')
+  book.add_argument('--baseline',
+                    help='compare with results saved by --save-baseline')
+  book.add_argument('--save-baseline', metavar='FILE',
+                    help='save the results to FILE as JSON')
+  generate = subparsers.add_parser('generate',
+                                   help='write a synthetic CESM style book')
+  generate.add_argument('directory', help='new directory for the book')
+  _add_book_arguments(generate)
+  diff = subparsers.add_parser('diff',
+                               help='compare the line-based and XML parsers')
+  _add_book_arguments(diff)
+  diff.add_argument('--source',
+                    help='master document of a book to use instead of a synthetic one')
+  slowfs = subparsers.add_parser('slowfs',
+                                 help='convert a synthetic book on a slow file system stand-in')
+  _add_book_arguments(slowfs)
+  slowfs.add_argument('--latency', type=float, default=0.05,
+                      help='seconds waited for every file opened')
+  slowfs.add_argument('--bandwidth', type=float, default=1.0,
+                      help='MB/s for reading and writing files')
+  slowfs.add_argument('--prefetch', default='0,1,2,4',
+                      help='comma separated db2rst.py --prefetch depths')
+  slowfs.add_argument('--repeat', type=int, default=3,
+                      help='number of timed conversions (best is reported)')
+  dispatch = subparsers.add_parser('dispatch',
+                                   help='tag handler dispatch micro-benchmark')
+  dispatch.add_argument('--handlers', default='0,10,100,1000,10000',
+                        help='comma separated numbers of extra tag handlers')
+  dispatch.add_argument('--repeat', type=int, default=5,
+                        help='number of timing repeats (best is reported)')
+  verbatim = subparsers.add_parser('verbatim',
+                                   help='convert a document with a long literal block')
+  verbatim.add_argument('--lines', default='1000,10000,100000',
+                        help='comma separated numbers of lines in the block')
+  verbatim.add_argument('--repeat', type=int, default=3,
+                        help='number of timing repeats (best is reported)')
+  assets = subparsers.add_parser('assets',
+                                 help='copy images (some the same) into a destination')
+  assets.add_argument('--images', type=int, default=2000,
+                      help='number of images')
+  assets.add_argument('--size', type=int, default=64,
+                      help='KiB per image')
+  assets.add_argument('--shared', type=float, default=0.5,
+                      help='fraction of images which are one of a few common ones')
+  assets.add_argument('--jobs', default='1,4,8',
+                      help='comma separated numbers of copier threads')
+  assets.add_argument('--destination',
+                      help='directory for the copies (default beside the images)')
+  args = parser.parse_args()
+  if (args.bench == 'scanner'):
+    _bench_scanner([ int(_x) for _x in args.attributes.split(',') ],
+                   args.repeat)
+  elif (args.bench == 'book'):
+    _bench_book(args)
+  elif (args.bench == 'generate'):
+    print(_synthetic_book(args.directory, _book_params(args)))
+  elif (args.bench == 'diff'):
+    sys.exit(_diff_parsers(args))
+  elif (args.bench == 'slowfs'):
+    sys.exit(_bench_slowfs(args))
+  elif (args.bench == 'dispatch'):
+    _bench_dispatch([ int(_x) for _x in args.handlers.split(',') ],
+                    args.repeat)
+  elif (args.bench == 'verbatim'):
+    _bench_verbatim([ int(_x) for _x in args.lines.split(',') ],
+                    args.repeat)
+  elif (args.bench == 'assets'):
+    _bench_assets(args)
+  # End if
+# End def _main
+
+def _synthetic_tag_line(nattrs):
+  # A (valid) line with one big tag holding nattrs quoted attributes
+  attrs = [ 'attr%d="value %d"'%(_x, _x) if (_x % 2) == 0 else
+            "attr%d='value %d'"%(_x, _x) for _x in range(nattrs) ]
+  return ('<ulink url="http://www.cesm.ucar.edu/" ' + ' '.join(attrs) +
+          '>the <command>CESM</command> web page</ulink>')
+# End def _synthetic_tag_line
+
+def _time_per_call(func, repeat):
+  # Best time per call (seconds) of func
+  timer = timeit.Timer(func)
+  number = 1
+  while (timer.timeit(number) < 0.05):
+    number = number * 2
+  # End while
+  return min(timer.repeat(repeat, number)) / number
+# End def _time_per_call
+
+def _bench_scanner(attr_counts, repeat):
+  print('%8s %10s %14s %18s %10s'%('attrs', 'chars', '_read_tags us',
+                                   '_complete_line us', 'ns/char'))
+  for nattrs in attr_counts:
+    line = _synthetic_tag_line(nattrs)
+    read = _time_per_call(lambda: db2rst._read_tags(line, 1, 'bench'), repeat)
+    comp = _time_per_call(lambda: db2rst._complete_line(line, 1, 'bench'),
+                          repeat)
+    print('%8d %10d %14.1f %18.1f %10.1f'%(nattrs, len(line), read * 1.0e6,
+                                           comp * 1.0e6,
+                                           comp * 1.0e9 / len(line)))
+  # End for
+# End def _bench_scanner
+
+def _bench_dispatch(handler_counts, repeat):
+  """Time _translate_string for lines with handled and unhandled tags as
+  extra handlers (for tags named extra0, extra1, ...) are registered.
+  The time per line should not depend on the number of handlers."""
+  lines = [ 'Use <literal>make</literal> and <option>-j</option> here.',
+            '<productname>CESM</productname> in <filename>a.txt</filename>',
+            'Run <command>cesm_setup</command> with <emphasis>care</emphasis>',
+            'The <extra0>first</extra0> and <extra9>tenth</extra9> extra tag',
+            'A line of plain text with no tags at all on it' ]
+  tagged = [ (_x, db2rst._read_tags(_x, 1, 'bench')[1]) for _x in lines ]
+  converter = db2rst.Converter()
+  registered = dict(db2rst._tag_handlers)
+  def translate():
+    for (line, tags) in tagged:
+      db2rst._translate_string(line, tags, converter.aliases, converter, '',
+                               1, 'bench')
+    # End for
+  # End def translate
+  print('%10s %10s %12s'%('handlers', 'extra', 'us/line'))
+  try:
+    for count in handler_counts:
+      db2rst._tag_handlers.clear()
+      db2rst._tag_handlers.update(registered)
+      db2rst._markup_handler([ 'extra%d'%_x for _x in range(count) ],
+                             '*', '*')
+      seconds = _time_per_call(translate, repeat)
+      print('%10d %10d %12.2f'%(len(db2rst._tag_handlers), count,
+                                seconds * 1.0e6 / len(lines)))
+    # End for
+  finally:
+    db2rst._tag_handlers.clear()
+    db2rst._tag_handlers.update(registered)
+  # End try
+# End def _bench_dispatch
+
+def _bench_verbatim(line_counts, repeat):
+  """Time the conversion of a document holding a programlisting of
+  namelist and shell lines (with unbalanced quotes) with both parsers."""
+  body = [ " &amp;cam_inparm nhtfrq = 0, -24, mfilt = 1, 30 /",
+           "./xmlchange -file env_run.xml -id STOP_OPTION -val 'ndays'",
+           "echo \"it's done\" &amp;&amp; ls &lt;dir&gt; # don't",
+           "    <userinput>./case.build</userinput> &cesm;",
+           "" ]
+  print('%10s %8s %12s'%('lines', 'parser', 'us/line'))
+  for count in line_counts:
+    lines = ([ '<?xml version="1.0"?>\n', '<!DOCTYPE chapter [\n',
+               '<!ENTITY cesm "CESM1.2">\n', ']>\n',
+               '<chapter id="ch1">\n', '<title>Namelists</title>\n',
+               '<para>\n', 'The settings:<programlisting>\n' ] +
+             [ body[_x % len(body)] + '\n' for _x in range(count) ] +
+             [ '</programlisting></para>\n', '</chapter>\n' ])
+    for parser in ('line', 'xml'):
+      def convert():
+        converter = db2rst.Converter(parser=parser)
+        for text in converter.convert_stream(lines, 'bench.xml'):
+          pass
+        # End for
+      # End def convert
+      stdout = sys.stdout
+      sys.stdout = StringIO() # Drop the section messages
+      try:
+        seconds = _time_per_call(convert, repeat)
+      finally:
+        sys.stdout = stdout
+      # End try
+      print('%10d %8s %12.2f'%(count, parser, seconds * 1.0e6 / count))
+    # End for
+  # End for
+# End def _bench_verbatim
+
+def _bench_assets(args):
+  """Time copying images into an empty destination, then again with
+  nothing changed, with each number of copier threads"""
+  workdir = tempfile.mkdtemp(prefix='db2rst_bench')
+  destdir = args.destination or workdir
+  rand = random.Random(1)
+  common = [ os.urandom(args.size * 1024) for _ in range(10) ]
+  lookups = []
+  try:
+    os.makedirs(os.path.join(workdir, 'images'))
+    for index in range(args.images):
+      data = os.urandom(args.size * 1024)
+      if (rand.random() < args.shared):
+        data = rand.choice(common)
+      # End if
+      lookups.append('image=images/img%d.png'%index)
+      with open(os.path.join(workdir, lookups[-1][6:]), 'wb') as image:
+        image.write(data)
+      # End with
+    # End for
+    master = os.path.join(workdir, 'master.xml')
+    print('%6s %10s %10s %8s %8s'%('jobs', 'first', 'unchanged', 'copied',
+                                   'inodes'))
+    for jobs in [ int(_x) for _x in args.jobs.split(',') ]:
+      dest = os.path.join(destdir, 'assets%d'%jobs)
+      if (os.path.exists(dest)):
+        shutil.rmtree(dest)
+      # End if
+      os.makedirs(os.path.join(dest, 'source'))
+      seconds = []
+      for load in (False, True):
+        manifest = db2rst._BuildManifest(dest, [], load=load)
+        copier = db2rst._AssetCopier(os.path.join(dest, 'source'), manifest,
+                                     jobs)
+        copier.add(master, lookups)
+        start = time.time()
+        copied = len(_quietly(copier.copy))
+        seconds.append(time.time() - start)
+        manifest.save()
+        if (not load):
+          first = copied
+        # End if
+      # End for
+      inodes = set([ os.stat(_x).st_ino for _x in copier.assets.keys() ])
+      print('%6d %10.3f %10.3f %8d %8d'%(jobs, seconds[0], seconds[1], first,
+                                         len(inodes)))
+      shutil.rmtree(dest)
+    # End for
+  finally:
+    shutil.rmtree(workdir)
+  # End try
+# End def _bench_assets
+
+def _add_book_arguments(parser):
+  parser.add_argument('--chapters', type=int, default=10,
+                      help='number of chapter sub-documents')
+  parser.add_argument('--lines', type=int, default=1000,
+                      help='number of text lines per chapter')
+  parser.add_argument('--aliases', type=int, default=50,
+                      help='number of !ENTITY aliases in the master document')
+  parser.add_argument('--tag-density', type=float, default=0.2,
+                      help='fraction of words which are tags or aliases')
+  parser.add_argument('--ulinks', type=float, default=0.05,
+                      help='fraction of lines starting a multi-line ulink')
+  parser.add_argument('--boilerplate', type=float, default=0.0,
+                      help='fraction of lines repeated from a few shared ones')
+  parser.add_argument('--blocks', type=float, default=0.2,
+                      help='fraction of sections ending with a list, a figure and an example')
+  parser.add_argument('--seed', type=int, default=1,
+                      help='random seed (the same seed gives the same book)')
+# End def _add_book_arguments
+
+def _book_params(args):
+  return { 'chapters' : args.chapters, 'lines' : args.lines,
+           'aliases' : args.aliases, 'tag_density' : args.tag_density,
+           'ulinks' : args.ulinks, 'boilerplate' : args.boilerplate,
+           'blocks' : args.blocks, 'seed' : args.seed }
+# End def _book_params
+
+def _synthetic_book(directory, params):
+  """Write a CESM style book described by params into directory (a
+  master document declaring the aliases, one file per chapter and a
+  placeholder image for each figure) and return the path of the master
+  document"""
+  rand = random.Random(params['seed'])
+  aliases = [ 'alias%d'%_x for _x in range(params['aliases']) ]
+  chapters = [ 'chap%d'%_x for _x in range(params['chapters']) ]
+  words = ( 'the', 'model', 'case', 'run', 'build', 'component', 'namelist',
+            'variable', 'grid', 'compset', 'machine', 'script', 'is', 'to' )
+  tags = ( '<command>create_newcase</command>', '<filename>env_run.xml</filename>',
+           '<envar>CASEROOT</envar>', '<varname>STOP_N</varname>',
+           '<acronym>CESM</acronym>', '<userinput>./case.submit</userinput>',
+           '<classname>Case</classname>', '&lt;', '&gt;' )
+  def text_line():
+    line = []
+    for _ in range(rand.randint(6, 14)):
+      if (rand.random() >= params['tag_density']):
+        line.append(rand.choice(words))
+      elif ((len(aliases) > 0) and (rand.random() < 0.3)):
+        line.append('&%s;'%rand.choice(aliases))
+      else:
+        line.append(rand.choice(tags))
+      # End if
+    # End for
+    return ' '.join(line)
+  # End def text_line
+  def blocks(chapter, section):
+    # A list, a figure (with an image) and an example (with a literal
+    # block), the figure and example have titles
+    kind = ('itemizedlist', 'orderedlist')[section % 2]
+    image = 'images/%s_%d.png'%(chapter, section)
+    with open(os.path.join(directory, image), 'wb') as imf:
+      imf.write(b'\x89PNG\r\n\x1a\n' + image.encode('ascii'))
+    # End with
+    lines = [ '<%s>'%kind ]
+    for _ in range(rand.randint(2, 4)):
+      lines.extend(('<listitem>', '<para>', text_line(), '</para>',
+                    '</listitem>'))
+    # End for
+    lines.extend(('</%s>'%kind,
+                  '<figure id="%s_fig%d">'%(chapter, section),
+                  '<title>Figure %d of %s</title>'%(section, chapter),
+                  '<mediaobject><imageobject><imagedata fileref="%s"/></imageobject></mediaobject>'%image,
+                  '</figure>', '<example>',
+                  '<title>Example %d of %s</title>'%(section, chapter),
+                  '<programlisting>', './xmlchange STOP_N=%d'%section,
+                  './case.submit', '</programlisting>', '</example>'))
+    return lines
+  # End def blocks
+  boilerplate = params.get('boilerplate', 0.0)
+  shared = [ text_line() for _ in range(20 if boilerplate > 0 else 0) ]
+  if (not os.path.isdir(os.path.join(directory, 'images'))):
+    os.makedirs(os.path.join(directory, 'images'))
+  # End if
+  master = os.path.join(directory, 'master.xml')
+  with open(master, 'w') as mf:
+    mf.write('<?xml version="1.0"?>\n<!DOCTYPE book PUBLIC "-//OASIS//DTD DocBook XML V4.1.2//EN"\n')
+    mf.write('"http://www.oasis-open.org/docbook/xml/4.1.2/docbookx.dtd"\n[\n')
+    for chapter in chapters:
+      mf.write('<!ENTITY %s SYSTEM "%s.xml">\n'%(chapter, chapter))
+    # End for
+    for (index, alias) in enumerate(aliases):
+      value = 'CESM component %d'%index
+      if ((index > 0) and (rand.random() < 0.2)):
+        value = '&%s; %s'%(aliases[rand.randrange(index)], value)
+      # End if
+      mf.write('<!ENTITY %s "%s">\n'%(alias, value))
+    # End for
+    mf.write(']>\n<book>\n')
+    for chapter in chapters:
+      mf.write('&%s;\n'%chapter)
+    # End for
+    mf.write('</book>\n')
+  # End with
+  for chapter in chapters:
+    with open(os.path.join(directory, chapter + '.xml'), 'w') as cf:
+      cf.write('<chapter id="%s">\n<title>The %s chapter</title>\n'%(chapter,
+                                                                      chapter))
+      section = 0
+      nlines = 0
+      while (nlines < params['lines']):
+        cf.write('<sect1 id="%s_sect%d">\n'%(chapter, section))
+        cf.write('<title>Section %d of %s</title>\n'%(section, chapter))
+        for _ in range(rand.randint(2, 6)):
+          cf.write('<para>\n')
+          for _ in range(rand.randint(3, 8)):
+            if (rand.random() < params['ulinks']):
+              cf.write('See <ulink url="http://www.cesm.ucar.edu/models/">the\n')
+              cf.write('%s</ulink> %s\n'%(text_line(), text_line()))
+              nlines = nlines + 2
+            elif ((boilerplate > 0) and (rand.random() < boilerplate)):
+              cf.write(rand.choice(shared) + '\n')
+              nlines = nlines + 1
+            else:
+              cf.write(text_line() + '\n')
+              nlines = nlines + 1
+            # End if
+          # End for
+          cf.write('</para>\n')
+        # End for
+        if ((params.get('blocks', 0.0) > 0) and
+            (rand.random() < params['blocks'])):
+          lines = blocks(chapter, section)
+          cf.write('\n'.join(lines) + '\n')
+          nlines = nlines + len(lines)
+        # End if
+        cf.write('</sect1>\n')
+        section = section + 1
+      # End while
+      cf.write('</chapter>\n')
+    # End with
+  # End for
+  return master
+# End def _synthetic_book
+
+def _convert_book(master, dest_path, parser='line', memo_size=4096):
+  # Convert master and its sub-documents in order (as db2rst.py does
+  # without --jobs), return the number of lines and bytes converted
+  db2rst._translation_memo = None # Start with an empty memo
+  converter = db2rst.Converter(parser=parser, memo_size=memo_size)
+  nlines = 0
+  nbytes = 0
+  docs = [ master ]
+  while (len(docs) > 0):
+    src_file = docs.pop(0)
+    subdocs = db2rst._translate_docbook_source(src_file, dest_path, converter,
+                                               master=(src_file == master))
+    with open(src_file) as sf:
+      for line in sf:
+        nlines = nlines + 1
+        nbytes = nbytes + len(line)
+      # End for
+    # End with
+    docs.extend([ db2rst._find_subdoc(_x, master) for _x in subdocs ])
+  # End while
+  return nlines, nbytes
+# End def _convert_book
+
+def _diff_parsers(args):
+  """Convert a book with each parser and print the differences between
+  the outputs, return 1 if there are any"""
+  workdir = tempfile.mkdtemp(prefix='db2rst_bench')
+  try:
+    master = args.source
+    if (master is None):
+      master = _synthetic_book(os.path.join(workdir, 'book'),
+                               _book_params(args))
+    # End if
+    outputs = {}
+    for parser in ('line', 'xml'):
+      dest_path = os.path.join(workdir, parser)
+      outputs[parser] = dest_path
+      try:
+        _quietly(_convert_book, master, dest_path, parser)
+      except (SystemExit, db2rst.ConversionError):
+        print('The %s parser stopped early'%parser)
+      # End try
+    # End for
+    ndiffs = 0
+    names = set()
+    for parser in outputs:
+      for (dirpath, dirnames, filenames) in os.walk(outputs[parser]):
+        names.update([ os.path.relpath(os.path.join(dirpath, _x),
+                                       outputs[parser]) for _x in filenames ])
+      # End for
+    # End for
+    for name in sorted(names):
+      texts = []
+      for parser in ('line', 'xml'):
+        path = os.path.join(outputs[parser], name)
+        if (os.path.exists(path)):
+          with open(path) as rf:
+            texts.append(rf.readlines())
+          # End with
+        else:
+          texts.append([])
+        # End if
+      # End for
+      diff = list(difflib.unified_diff(texts[0], texts[1], 'line/' + name,
+                                       'xml/' + name))
+      if (len(diff) > 0):
+        ndiffs = ndiffs + 1
+        sys.stdout.writelines(diff)
+      # End if
+    # End for
+  finally:
+    shutil.rmtree(workdir)
+  # End try
+  print('%d of %d output files differ'%(ndiffs, len(names)))
+  return 1 if ndiffs > 0 else 0
+# End def _diff_parsers
+
+class _SlowWriter(object):
+  """An output file on the slow file system stand-in, closing it waits
+  for the bytes written to go out"""
+
+  def __init__(self, fh, bandwidth):
+    self._fh = fh
+    self._bandwidth = bandwidth
+    self._nbytes = 0
+  # End def __init__
+
+  def write(self, data):
+    self._nbytes = self._nbytes + len(data)
+    self._fh.write(data)
+  # End def write
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+    # End for
+  # End def writelines
+
+  def close(self):
+    if (not self._fh.closed):
+      self._fh.close()
+      time.sleep(self._nbytes / self._bandwidth)
+    # End if
+  # End def close
+
+  def __enter__(self):
+    return self
+  # End def __enter__
+
+  def __exit__(self, *exc):
+    self.close()
+  # End def __exit__
+# End class _SlowWriter
+
+def _slow_open(latency, bandwidth):
+  """Return a replacement for open (in db2rst) simulating a network file
+  system: opening waits latency seconds and the whole file is read, or
+  written, at bandwidth bytes per second"""
+  real_open = open
+  def slow_open(path, mode='r', *args):
+    time.sleep(latency)
+    fh = real_open(path, mode, *args)
+    if (('r' in mode) and ('+' not in mode)):
+      time.sleep(os.path.getsize(path) / bandwidth)
+      return fh
+    # End if
+    return _SlowWriter(fh, bandwidth)
+  # End def slow_open
+  return slow_open
+# End def _slow_open
+
+def _same_tree(dir1, dir2):
+  # Do dir1 and dir2 hold the same files with the same contents?
+  cmp = filecmp.dircmp(dir1, dir2)
+  if ((len(cmp.left_only) > 0) or (len(cmp.right_only) > 0) or
+      (len(cmp.funny_files) > 0)):
+    return False
+  # End if
+  match, mismatch, errors = filecmp.cmpfiles(dir1, dir2, cmp.common_files,
+                                             shallow=False)
+  if ((len(mismatch) > 0) or (len(errors) > 0)):
+    return False
+  # End if
+  return all([ _same_tree(os.path.join(dir1, _x), os.path.join(dir2, _x))
+               for _x in cmp.common_dirs ])
+# End def _same_tree
+
+def _bench_slowfs(args):
+  """Time the conversion of a synthetic book (best of args.repeat) with
+  every open in db2rst.py slowed down, for each --prefetch depth, and
+  check the outputs are the same. Return 1 if any differs."""
+  depths = [ int(_x) for _x in args.prefetch.split(',') ]
+  workdir = tempfile.mkdtemp(prefix='db2rst_bench')
+  db2rst.open = _slow_open(args.latency, args.bandwidth * 1.0e6)
+  try:
+    master = _synthetic_book(os.path.join(workdir, 'book'),
+                             _book_params(args))
+    results = []
+    for depth in depths:
+      dest_path = os.path.join(workdir, 'prefetch%d'%depth, 'source')
+      best = None
+      for _ in range(args.repeat):
+        if (os.path.exists(dest_path)):
+          shutil.rmtree(dest_path)
+        # End if
+        os.makedirs(dest_path)
+        start = time.time()
+        _quietly(db2rst._convert_documents, master, dest_path,
+                 db2rst.Converter(), 1, None, depth)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+      # End for
+      results.append((depth, best, dest_path))
+    # End for
+  finally:
+    del db2rst.open
+  # End try
+  try:
+    print('%-10s %10s %8s %10s'%('prefetch', 'seconds', 'speedup',
+                                 'output'))
+    ndiffs = 0
+    for (depth, seconds, dest_path) in results:
+      same = _same_tree(results[0][2], dest_path)
+      if (not same):
+        ndiffs = ndiffs + 1
+      # End if
+      print('%-10d %10.3f %8.2f %10s'%(depth, seconds, results[0][1] / seconds,
+                                       'same' if same else 'DIFFERS'))
+    # End for
+  finally:
+    shutil.rmtree(workdir)
+  # End try
+  return 1 if ndiffs > 0 else 0
+# End def _bench_slowfs
+
+def _quietly(func, *args):
+  # Call func with console output discarded (unless func fails)
+  stdout, stderr = sys.stdout, sys.stderr
+  sys.stdout, sys.stderr = StringIO(), StringIO()
+  try:
+    return func(*args)
+  except (SystemExit, db2rst.ConversionError):
+    stderr.write(sys.stderr.getvalue())
+    raise
+  finally:
+    sys.stdout, sys.stderr = stdout, stderr
+  # End try
+# End def _quietly
+
+def _peak_rss():
+  # Peak resident memory of this process in KiB (or None)
+  if (resource is None):
+    return None
+  # End if
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if (sys.platform == 'darwin'):
+    peak = peak // 1024 # Bytes on macOS
+  # End if
+  return peak
+# End def _peak_rss
+
+def _bench_book(args):
+  """Time the conversion of a synthetic book end to end (best of
+  args.repeat) and by phase (one run with db2rst profiling), then
+  report and optionally save or compare the results"""
+  params = _book_params(args)
+  workdir = tempfile.mkdtemp(prefix='db2rst_bench')
+  try:
+    master = _synthetic_book(os.path.join(workdir, 'book'), params)
+    dest_path = os.path.join(workdir, 'source')
+    rss_start = _peak_rss()
+    best = None
+    for _ in range(args.repeat):
+      start = time.time()
+      nlines, nbytes = _quietly(_convert_book, master, dest_path,
+                                args.parser, args.memo_size)
+      elapsed = time.time() - start
+      best = elapsed if best is None else min(best, elapsed)
+    # End for
+    rss_peak = _peak_rss()
+    # Profile last so the timed runs are not instrumented
+    db2rst._instrument()
+    db2rst._profile = db2rst._Profile()
+    try:
+      _quietly(_convert_book, master, dest_path, args.parser, args.memo_size)
+      profile = db2rst._profile.data()
+      phases = profile['phases']
+    finally:
+      db2rst._profile = None
+    # End try
+  finally:
+    shutil.rmtree(workdir)
+  # End try
+  results = { 'params' : params, 'parser' : args.parser, 'lines' : nlines, 'bytes' : nbytes,
+              'seconds' : best, 'lines_per_second' : nlines / best,
+              'peak_rss_kib' : rss_peak,
+              'rss_growth_kib' : (None if rss_peak is None else
+                                  rss_peak - rss_start),
+              'phases' : dict([ (_x, phases[_x][1]) for _x in phases ]),
+              'memo' : profile['memo'] }
+  baseline = None
+  if (args.baseline is not None):
+    with open(args.baseline) as bf:
+      baseline = json.load(bf)
+    # End with
+    if (baseline['params'] != params):
+      print('WARNING: baseline was run with %s'%baseline['params'])
+    # End if
+  # End if
+  _report_book(results, baseline)
+  if (args.save_baseline is not None):
+    with open(args.save_baseline, 'w') as bf:
+      json.dump(results, bf, indent=1, sort_keys=True)
+    # End with
+  # End if
+# End def _bench_book
+
+def _report_book(results, baseline=None):
+  print('%d lines, %d bytes'%(results['lines'], results['bytes']))
+  if ('memo' in results):
+    print('translation memo: %d hits, %d misses'%tuple(results['memo']))
+  # End if
+  rows = [ ('end to end (s)', results['seconds'],
+            baseline and baseline['seconds']),
+           ('lines/s', results['lines_per_second'],
+            baseline and baseline['lines_per_second']),
+           ('peak RSS (KiB)', results['peak_rss_kib'],
+            baseline and baseline['peak_rss_kib']),
+           ('RSS growth (KiB)', results['rss_growth_kib'],
+            baseline and baseline['rss_growth_kib']) ]
+  for phase in db2rst._Profile.phases:
+    if (phase in results['phases']):
+      rows.append(('  %s (s)'%phase, results['phases'][phase],
+                   baseline and baseline['phases'].get(phase)))
+    # End if
+  # End for
+  print('%-28s %14s %14s %8s'%('', 'current', 'baseline', 'ratio'))
+  for (name, value, base) in rows:
+    if (value is None):
+      continue
+    # End if
+    if (base):
+      print('%-28s %14.4f %14.4f %8.2f'%(name, value, base,
+                                        float(value) / base))
+    else:
+      print('%-28s %14.4f'%(name, value))
+    # End if
+  # End for
+# End def _report_book
+
+if __name__ == '__main__':
+   _main()
+# End if
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Tests of the DocBook readers of db2rst.py
+    =========================
+    The line-based and XML parsers must give the same ReST for a
+    well-formed book. Run from the directory containing db2rst.py, e.g.,
+      python -m unittest discover tests
+
+"""
+
+# Python 3 compatible printing in Python 2.
+from __future__ import print_function
+import os
+import os.path
+import sys
+import shutil
+import tempfile
+import unittest
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
+# End try
+
+_here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(_here))
+import db2rst
+
+_corpus = os.path.join(_here, 'corpus', 'master.xml')
+
+def _convert_book(master, dest_path, parser):
+  # Convert master and its sub-documents in order with parser (as
+  # db2rst.py does without --jobs), return { output name : text }
+  db2rst._translation_memo = None # Start with an empty memo
+  converter = db2rst.Converter(parser=parser)
+  stdout, stderr = sys.stdout, sys.stderr
+  sys.stdout, sys.stderr = StringIO(), StringIO()
+  try:
+    docs = [ master ]
+    while (len(docs) > 0):
+      src_file = docs.pop(0)
+      subdocs = db2rst._translate_docbook_source(src_file, dest_path,
+                                                 converter,
+                                                 master=(src_file == master))
+      docs.extend([ db2rst._find_subdoc(_x, master) for _x in subdocs ])
+    # End while
+  finally:
+    sys.stdout, sys.stderr = stdout, stderr
+  # End try
+  outputs = {}
+  for name in sorted(os.listdir(dest_path)):
+    with open(os.path.join(dest_path, name)) as rf:
+      outputs[name] = rf.read()
+    # End with
+  # End for
+  return outputs
+# End def _convert_book
+
+class ParserTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workdir = tempfile.mkdtemp(prefix='db2rst_test')
+  # End def setUp
+
+  def tearDown(self):
+    shutil.rmtree(self.workdir)
+  # End def tearDown
+
+  def convert(self, parser):
+    dest_path = os.path.join(self.workdir, parser)
+    os.makedirs(dest_path)
+    return _convert_book(_corpus, dest_path, parser)
+  # End def convert
+
+  def test_same_output(self):
+    line = self.convert('line')
+    xml = self.convert('xml')
+    self.assertEqual(sorted(line.keys()),
+                     [ 'intro.rst', 'master.rst', 'usage.rst' ])
+    self.assertEqual(sorted(line.keys()), sorted(xml.keys()))
+    for name in sorted(line.keys()):
+      self.assertEqual(line[name], xml[name],
+                       '%s differs between the parsers'%name)
+    # End for
+  # End def test_same_output
+
+  def test_inline_items(self):
+    # A list item on one line (with its para) keeps its text, emphasis
+    # is ReST emphasis
+    for parser in ('line', 'xml'):
+      text = self.convert(parser)['usage.rst']
+      self.assertTrue('\n* cesm.log\n' in text, parser)
+      self.assertTrue('\n* atm.log and *lnd.log*\n' in text, parser)
+      self.assertTrue('Check the *log files* first:' in text, parser)
+    # End for
+  # End def test_inline_items
+# End class ParserTest
+
+if __name__ == '__main__':
+  unittest.main()
+# End if
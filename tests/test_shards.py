@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Tests of converting a document in shards (db2rst.py -j N --shard-lines)
+    =========================
+    A document converted in shards must give the same ReST as converting
+    it serially, also when a shard starts inside a list. Run from the
+    directory containing db2rst.py, e.g.,
+      python -m unittest discover tests
+
+"""
+
+# Python 3 compatible printing in Python 2.
+from __future__ import print_function
+import os
+import os.path
+import sys
+import shutil
+import tempfile
+import unittest
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
+# End try
+
+_here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(_here))
+import db2rst
+
+_book = os.path.join(_here, 'shards', 'master.xml')
+_shard_lines = 20
+
+class ShardTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workdir = tempfile.mkdtemp(prefix='db2rst_test')
+  # End def setUp
+
+  def tearDown(self):
+    shutil.rmtree(self.workdir)
+  # End def tearDown
+
+  def convert(self, name, jobs, shard_lines=0):
+    # Convert the book into workdir/name, return { output name : text }
+    dst_path = os.path.join(self.workdir, name, 'source')
+    os.makedirs(dst_path)
+    db2rst._translation_memo = None # Start with an empty memo
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = StringIO(), StringIO()
+    try:
+      db2rst._convert_documents(_book, dst_path, db2rst.Converter(), jobs,
+                                shard_lines=shard_lines)
+    finally:
+      sys.stdout, sys.stderr = stdout, stderr
+    # End try
+    outputs = {}
+    for name in os.listdir(dst_path):
+      if (name.endswith('.rst')):
+        with open(os.path.join(dst_path, name)) as rf:
+          outputs[name] = rf.read()
+        # End with
+      # End if
+    # End for
+    return outputs
+  # End def convert
+
+  def test_book_is_sharded(self):
+    plan = db2rst._shard_plan(os.path.join(_here, 'shards', 'steps.xml'),
+                              _shard_lines, 4)
+    self.assertTrue(plan is not None)
+    self.assertTrue(len(plan[0]) > 1)
+  # End def test_book_is_sharded
+
+  def test_same_as_serial(self):
+    serial = self.convert('serial', 1)
+    sharded = self.convert('sharded', 2, _shard_lines)
+    self.assertEqual(sorted(serial.keys()), [ 'master.rst', 'steps.rst' ])
+    self.assertEqual(sorted(serial.keys()), sorted(sharded.keys()))
+    for name in sorted(serial.keys()):
+      self.assertEqual(serial[name], sharded[name],
+                       '%s differs when sharded'%name)
+    # End for
+  # End def test_same_as_serial
+# End class ShardTest
+
+if __name__ == '__main__':
+  unittest.main()
+# End if